@@ -6,7 +6,7 @@ ssl = {
 } # ADD YOUR SSL HERE
 
 from sanic import Sanic
-from sanic.response import html
+from sanic.response import html, text
 from sanic_ext import Extend
 
 
@@ -18,15 +18,16 @@ from asyncio import Queue
 import traceback
 import logging
 from datetime import datetime
-from time import mktime
+from time import mktime, perf_counter
 from sanic.response import HTTPResponse
 from sanic.exceptions import NotFound
 
 # BLUEPRINTS #
 from blueprints.group import api
+from blueprints.admin import blueprint as admin
 
 # UTILS #
-from utils import redis, hashing, sse, cors, discord_legacy_webhook
+from utils import redis, hashing, sse, cors, discord_legacy_webhook, id_generator, message_cache, session_cache, broker, registry, write_behind, metrics, query_stats, tracing
 
 # Make sure configs exist.
 if not path.isfile("server_data/db.json") or not path.isfile("server_data/origins.json") or not path.isfile("server_data/config.json"):
@@ -62,33 +63,82 @@ if path.isfile("FIRSTRUNDONTTOUCH"):
     print("Starting...")
 
 
+# Unique per node, every worker on the node gets its own process bits on top of it.
+id_generator.configure(_config.get("node_id", 0))
+
 # Webserver
 _app = Sanic("API")
 _app.config.CORS_ORIGINS = _origins
+_app.config.ADMIN_KEY = _config.get("admin_key") # Admin routes are off without one.
 
 # Add OPTIONS handlers to any route that is missing it for CORS
 _app.register_listener(cors.setup_options, "before_server_start")
 
 
 # Create DB, Redis, Hasher, SSE Object
-_db = db.DB(db.mariadb_pool(0)) # Create the connection to the DB
-_redis = redis.RDB
-_hasher = hashing.Hasher()
-_sse = sse.SSE(Queue(), _db)
+_redis = redis.ARDB # Async, pooled
+_db = db.AsyncDB(db.DB(db.mariadb_pool(0), db.replica_pools(0))) # Create the connection to the DB, queries run off the event loop
+_stickiness = db.Stickiness(_redis, db.db_config().get("replica_sticky_seconds", 2)) if _db.db.replicas else None
+_db_request_transaction = _config.get("db_request_transaction", False) # Wrap every request in one transaction.
+_hasher = hashing.Hasher(_config.get("argon2"), _config.get("hash_threads", 2), _config.get("hash_max_waiting", 64))
+_sse = sse.SSE(Queue(), _db, outbound=registry.OutboundPolicy(_config.get("connection_queue_size", 256), _config.get("slow_consumer_policy", "disconnect")))
+_writes = write_behind.WriteBehind(_db, **_config.get("write_behind", {})) # Batches message inserts when enabled.
+if _writes.enabled and _db_request_transaction: # Batched inserts commit on their own, a request transaction couldnt cover them.
+    print("write_behind and db_request_transaction cant both be enabled, turn one of them off in config.json.")
+    exit(0)
+_sessions = session_cache.SessionCache(_redis, _config.get("session_cache_size", 50000), _config.get("session_cache_ttl", 60))
+_message_cache = message_cache.MessageCache(_redis, _config.get("message_cache_messages", 100), _config.get("message_cache_threads", 10000))
 _app.add_task(_sse.event_push_loop) # Make sure we run the event pusher, or nobody will be getting events
-# NOTE: the python WS loop floors a single thread to 100% 24/7.
+_app.add_task(_db.keep_alive) # Throws out dead DB connections before requests get them
+if _config.get("event_broker", True): # Needed for events to reach people connected to other workers or nodes.
+    _sse.broker = broker.EventBroker(_redis, _sse, _db)
+    _app.add_task(_sse.broker.listen)
+
+# Sampled request traces, Zipkin v2 JSON lines or in memory
+if _config.get("tracing", {}).get("enabled", False):
+    tracing.TRACER.configure(**{k: v for k, v in _config["tracing"].items() if k != "enabled"})
+
+# Per statement DB timings, slow query log and N+1 detection
+query_stats.STATS.slow_seconds = _config.get("slow_query_ms", 100) / 1000
+query_stats.STATS.n_plus_one = _config.get("n_plus_one_threshold", 5)
+
+# Metrics, read when /metrics is scraped. Anything recorded per request or per event lives next to the code doing it.
+_request_seconds = metrics.histogram("http_request_seconds", "Request latency by route.", ("route", "method"))
+_responses = metrics.counter("http_responses_total", "Responses by route and status.", ("route", "method", "status"))
+metrics.gauge("db_pool_connections", "DB connections by pool and state.",
+    lambda: {(pool.name, state): pool.stats()[state] for pool in _db.pools for state in ("open", "in_use", "idle", "waiting")}, ("pool", "state"))
+metrics.read_counter("db_pool_failures_total", "Checkouts that timed out or were turned away, and dead connections thrown out.",
+    lambda: {(pool.name, reason): pool.stats()[reason] for pool in _db.pools for reason in ("timeouts", "rejected", "evicted")}, ("pool", "reason"))
+metrics.gauge("sse_queue_depth", "Events waiting for the push loop.", lambda: _sse.queue.qsize())
+metrics.gauge("sse_online_users", "Users with at least one connection to this worker.", lambda: len(_sse.conns))
+metrics.gauge("sse_connections", "Open event connections on this worker.", lambda: _sse.conns.connections)
+metrics.read_counter("sse_outbound_events_total", "Slow consumer handling.",
+    lambda: {(what,): getattr(_sse.conns.policy, what) for what in ("dropped", "coalesced", "disconnected")}, ("what",))
+metrics.read_counter("session_cache_lookups_total", "Session cache lookups.", lambda: {("hit",): _sessions.hits, ("miss",): _sessions.misses}, ("result",))
+metrics.read_counter("db_statement_calls_total", "Statements run, by fingerprint.",
+    lambda: {(entry["fingerprint"],): entry["count"] for entry in query_stats.STATS.snapshot()}, ("fingerprint",))
+metrics.read_counter("db_statement_seconds_total", "Time spent running statements, by fingerprint.",
+    lambda: {(entry["fingerprint"],): entry["total_seconds"] for entry in query_stats.STATS.snapshot()}, ("fingerprint",))
+metrics.gauge("db_statement_seconds", "p50/p99 of recent runs, by fingerprint.",
+    lambda: {(entry["fingerprint"], stat): entry[f"{stat}_seconds"] for entry in query_stats.STATS.snapshot() for stat in ("p50", "p99")}, ("fingerprint", "stat"))
+metrics.gauge("hasher_pending", "Password hashes running or waiting.", lambda: _hasher.pending)
 
 # Add all the blueprints
 
 # Api (V1)
 _app.blueprint(api)
 
+# Admin (profiling)
+_app.blueprint(admin)
+
 # Error handler
 @_app.exception(Exception)
 async def catch_everything(request, exception):
     # TODO: work on this more, i dont know how sanic errors work and how to isinstance them
     if isinstance(exception, NotFound):
         return HTTPResponse("URL not found.", 404)
+    if isinstance(exception, (hashing.HasherBusy, db.PoolTimeout)): # Login storm or DB pool ran dry, ask them to come back instead of piling up.
+        return HTTPResponse("Too busy, try again later.", 503, headers={"Retry-After": "1"})
     unix_time = mktime(datetime.now().timetuple())
     _traceback = traceback.extract_tb(exception.__traceback__)
     with open(f"errors/{unix_time}.txt", "w+") as f:
@@ -106,13 +156,63 @@ async def catch_everything(request, exception):
 
 
 
+def requester(request): # Who the request claims to be, only used to send their reads to the primary after they write.
+    if _stickiness is None:
+        return None
+    try:
+        body = request.json
+    except Exception: # The handler will complain about it.
+        return None
+    if isinstance(body, dict) and isinstance(body.get("requester"), int):
+        return body["requester"]
+    return None
+
 # Inject everything needed.
 @_app.on_request
 async def setup_connection(request):
-    request.ctx.db = _db
+    websocket = request.route is not None and request.route.extra.websocket
+    route = request.route.path if request.route is not None else "unmatched"
+    if websocket: # Lives as long as the socket, dont pin a connection to it.
+        request.ctx.db = _db
+    else: # Checked out on first query, released below.
+        request.ctx.db = db.LeasedDB(_db, _db_request_transaction, requester(request), _stickiness)
     request.ctx.redis = _redis
     request.ctx.hasher = _hasher
     request.ctx.sse = _sse
+    request.ctx.message_cache = _message_cache
+    request.ctx.sessions = _sessions
+    request.ctx.writes = _writes
+    request.ctx.started = perf_counter()
+    query_stats.STATS.begin_request(route)
+    if websocket: # A trace as long as the socket would be useless, events it sends are traced on their own.
+        tracing.current.set(None)
+        request.ctx.trace = None
+    else:
+        request.ctx.trace = tracing.TRACER.start_trace(f"{request.method} {route}", "SERVER", path=request.path)
+
+@_app.on_response
+async def record_request(request, response):
+    started = getattr(request.ctx, "started", None)
+    if started is None: # Failed before setup_connection ran.
+        return
+    query_stats.STATS.end_request()
+    route = request.route.path if request.route is not None else "unmatched" # The pattern, not the URL, so IDs dont blow up the label count.
+    _request_seconds.observe(perf_counter() - started, route, request.method)
+    _responses.inc(route, request.method, response.status)
+    if request.ctx.trace is not None:
+        request.ctx.trace.tag("status", response.status)
+        request.ctx.trace.finish()
+
+# Give the request's DB connection back, in transaction mode only successful requests commit.
+@_app.on_response
+async def release_connection(request, response):
+    if isinstance(getattr(request.ctx, "db", None), db.LeasedDB):
+        await request.ctx.db.release(commit=response.status < 400)
+
+if _config.get("metrics", True): # Keep it off the public internet, Prometheus only needs to reach it from inside.
+    @_app.route("/metrics")
+    async def metrics_endpoint(request):
+        return text(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 if _config["api_landing_page"] == True:
     _temp = open(_config["api_landing_page_location"], "r") # TODO: check if exists
@@ -126,10 +226,28 @@ if _config["api_landing_page"] == True:
     # TODO: when webapp is finished, redirect to webapp subdomain.
     
 
+# Listen for session invalidations while this worker is serving
+@_app.after_server_start
+async def start_session_cache(app, loop):
+    _sessions.start()
+
+@_app.before_server_stop
+async def stop_session_cache(app, loop):
+    _sessions.stop()
+    _hasher.close()
+    tracing.TRACER.close()
+
+
+# Dont lose buffered inserts when a worker stops
+@_app.before_server_stop
+async def flush_writes(app, loop):
+    await _writes.close()
+
+
 # Close the DB on exit
 @_app.main_process_stop
 async def close_db(app, loop):
-    _db.pool.close()
+    _db.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,64 @@
+# Fanout cost per recipient, before and after sharing one encoded frame between every connection.
+# Run from the repo root: python -m benchmarks.fanout [recipients ...]
+import asyncio
+import sys
+from json import dumps as legacy_dumps
+from time import perf_counter
+
+from models.events import Event
+from utils.sse import SSE
+
+ROUNDS = 20
+
+
+class NullConnection: # Stands in for a websocket, we only care about the cost of building the frames.
+    __slots__ = ()
+
+    async def send(self, frame):
+        pass
+
+
+def make_event() -> Event:
+    return Event("new_message", 1, 1, "guild", {
+        "author": 1234567890123456789,
+        "id": 9876543210987654321,
+        "thread": 1122334455667788990,
+        "content": "The quick brown fox jumps over the lazy dog. " * 4,
+        "timestamp": 1690000000.123456
+    })
+
+
+def legacy_format(event: Event): # What SSE.format did before: one json.dumps per recipient.
+    return f'event: {event.event}\ndata: {legacy_dumps(event.data)}'
+
+
+async def legacy_fanout(sse: SSE, conns: list):
+    event = make_event()
+    await asyncio.gather(*[conn.send(legacy_format(event)) for conn in conns])
+
+
+async def shared_fanout(sse: SSE, conns: list):
+    event = make_event()
+    frame = sse.format(event)
+    await asyncio.gather(*[conn.send(frame) for conn in conns])
+
+
+async def measure(fanout, sse: SSE, conns: list) -> float:
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        await fanout(sse, conns)
+    return (perf_counter() - start) / (ROUNDS * len(conns))
+
+
+async def main(sizes: list[int]):
+    sse = SSE(asyncio.Queue(), None)
+    print(f"{'recipients':>10} {'before (us/recipient)':>22} {'after (us/recipient)':>21} {'speedup':>8}")
+    for size in sizes:
+        conns = [NullConnection() for _ in range(size)]
+        before = await measure(legacy_fanout, sse, conns)
+        after = await measure(shared_fanout, sse, conns)
+        print(f"{size:>10} {before * 1e6:>22.3f} {after * 1e6:>21.3f} {before / after:>7.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main([int(x) for x in sys.argv[1:]] or [10, 100, 1000, 5000]))
@@ -0,0 +1,316 @@
+# End to end load test. Boots api.py in a subprocess against SQLite and fakeredis (benchmarks/standins.py), then drives
+# it over HTTP and websockets: user create/login, message send, message reads (cached and history) and websocket fanout.
+# Needs fakeredis and lupa on top of the usual dependencies. mariadb still has to be importable, nothing connects to it.
+# Run from the repo root: python -m benchmarks.load [--users 32] [--requests 2000] [--concurrency 16] [--clients 100]
+# [--fanout-messages 50] [--set key=json ...] [--json results.json]
+# --set overrides config.json keys for the run, e.g. --set 'write_behind={"enabled": true}'.
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from json import dumps, loads
+from time import perf_counter
+
+from benchmarks import standins
+
+try:
+    from websockets.asyncio.client import connect as ws_connect # websockets 13+
+    WS_HEADERS = "additional_headers"
+except ImportError:
+    from websockets import connect as ws_connect
+    WS_HEADERS = "extra_headers"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "127.0.0.1"
+DB_FILE = "bench.sqlite3"
+PASSWORD = "correct horse battery staple"
+CHANNEL = 1 # DM channel every benchmark user is a member of
+
+
+def write_configs(workdir: str, overrides: dict) -> None:
+    os.makedirs(os.path.join(workdir, "server_data"))
+    os.makedirs(os.path.join(workdir, "errors"))
+    with open(os.path.join(ROOT, "server_data", "config.json.example")) as f:
+        config = loads(f.read())
+    config["api_landing_page"] = False
+    config.update(overrides)
+    with open(os.path.join(workdir, "server_data", "config.json"), "w") as f:
+        f.write(dumps(config, indent=4))
+    with open(os.path.join(workdir, "server_data", "origins.json"), "w") as f:
+        f.write(dumps({"list": None}))
+    with open(os.path.join(workdir, "server_data", "discord_legacy_webhooks.json"), "w") as f:
+        f.write(dumps({"enabled": False}))
+    shutil.copy(os.path.join(ROOT, "server_data", "db.json.example"), os.path.join(workdir, "server_data", "db.json"))
+    standins.create_schema(os.path.join(workdir, DB_FILE))
+
+
+def serve(workdir: str, port: int) -> None:
+    """ The server side, runs in its own process so the load generator doesnt share its event loop. """
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.chdir(workdir) # api.py reads server_data/ from the working directory.
+    from utils import redis
+    redis.ARDB = standins.fake_redis() # Before api.py grabs it.
+    redis.POOL = redis.ARDB.connection_pool
+    import api
+    from utils import db
+    api._db.db = db.DB(standins.sqlite_pool(os.path.join(workdir, DB_FILE)))
+    api._app.run(host=HOST, port=port, single_process=True, access_log=False, motd=False)
+
+
+class HTTP:
+    """ Bare keep-alive HTTP/1.1 client, enough for our JSON API and cheap enough not to be what we measure. """
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: dict | None = None) -> tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+        data = dumps(body).encode() if body is not None else b""
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {HOST}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split(b" ", 2)[1])
+        length, close = 0, False
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode().partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection" and value.strip().lower() == "close":
+                close = True
+        content = await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status, content
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class Result:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.latencies = [] # seconds
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def row(self) -> dict:
+        ordered = sorted(self.latencies)
+        def percentile(fraction):
+            return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] * 1000 if ordered else 0.0
+        return {
+            "workload": self.name,
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "per_second": len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+            "p50_ms": percentile(0.5),
+            "p90_ms": percentile(0.9),
+            "p99_ms": percentile(0.99),
+            "max_ms": ordered[-1] * 1000 if ordered else 0.0
+        }
+
+
+async def drive(name: str, port: int, count: int, concurrency: int, make) -> tuple[Result, list]:
+    """ Sends make(i) -> (method, path, body) for i in range(count), `concurrency` connections at a time. Returns the parsed 200 responses by i. """
+    result = Result(name)
+    responses = [None] * count
+    todo = iter(range(count))
+
+    async def worker():
+        client = HTTP(port)
+        try:
+            for i in todo:
+                method, path, body = make(i)
+                start = perf_counter()
+                try:
+                    status, content = await client.request(method, path, body)
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    client.close()
+                    result.errors += 1
+                    continue
+                result.latencies.append(perf_counter() - start)
+                if status == 200:
+                    responses[i] = loads(content)
+                else:
+                    result.errors += 1
+        finally:
+            client.close()
+
+    start = perf_counter()
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, count))])
+    result.elapsed = perf_counter() - start
+    return result, responses
+
+
+async def fanout(port: int, users: list[tuple[int, str]], clients: int, messages: int) -> Result:
+    """ `clients` websockets (spread over every user but the sender) get `messages` sent one after another, latency is send to delivery. """
+    result = Result(f"ws_fanout x{clients}")
+    (sender, sender_auth), receivers = users[0], users[1:] or users
+    sent_at = dict() # message number -> when its send started
+    sockets = []
+    for i in range(clients):
+        user, auth = receivers[i % len(receivers)]
+        ws = await ws_connect(f"ws://{HOST}:{port}/api/events/ws", **{WS_HEADERS: {"Authorization": auth, "Author": str(user)}}, max_queue=None)
+        if await ws.recv() != "recognized":
+            raise RuntimeError(f"Websocket for user {user} was not accepted.")
+        sockets.append(ws)
+
+    async def receive(ws):
+        got = 0
+        while got < messages:
+            frame = await ws.recv()
+            arrived = perf_counter()
+            if not frame.startswith("event: new_message"):
+                continue
+            number = int(loads(frame.split("\n", 1)[1][len("data: "):])["content"].split()[-1])
+            result.latencies.append(arrived - sent_at[number])
+            got += 1
+
+    listeners = [asyncio.create_task(receive(ws)) for ws in sockets]
+    client = HTTP(port)
+    start = perf_counter()
+    for number in range(messages):
+        sent_at[number] = perf_counter()
+        status, _ = await client.request("POST", f"/api/message/dmchannel/{CHANNEL}/create", {"requester": sender, "auth": sender_auth, "content": f"fanout {number}"})
+        if status != 200:
+            result.errors += 1
+    done, pending = await asyncio.wait(listeners, timeout=30) if listeners else (set(), set())
+    result.elapsed = perf_counter() - start
+    result.errors += len(pending) # Clients that never got every message.
+    for task in pending:
+        task.cancel()
+    client.close()
+    await asyncio.gather(*[ws.close() for ws in sockets], return_exceptions=True)
+    return result
+
+
+async def run(args, port: int, workdir: str) -> list[Result]:
+    results = []
+
+    created, responses = await drive("user_create", port, args.users, args.concurrency,
+        lambda i: ("POST", "/api/user/create", {"username": f"bench{i}", "password": PASSWORD}))
+    results.append(created)
+    ids = [response["id"] for response in responses if response is not None]
+    if not ids:
+        raise RuntimeError("No users could be created, check the server log.")
+
+    login, responses = await drive("user_login", port, len(ids), args.concurrency,
+        lambda i: ("POST", f"/api/user/{ids[i]}/authkey", {"auth": PASSWORD}))
+    results.append(login)
+    users = [(response["id"], response["authentication"]) for response in responses if response is not None]
+    if not users:
+        raise RuntimeError("No users could log in, check the server log.")
+    standins.add_members(os.path.join(workdir, DB_FILE), "dmchannelusers", CHANNEL, [user for user, _ in users])
+
+    def as_user(i):
+        user, auth = users[i % len(users)]
+        return {"requester": user, "auth": auth}
+
+    send, _ = await drive("message_send", port, args.requests, args.concurrency,
+        lambda i: ("POST", f"/api/message/dmchannel/{CHANNEL}/create", {**as_user(i), "content": f"load message {i}"}))
+    results.append(send)
+
+    latest, _ = await drive("message_mass_get", port, args.requests, args.concurrency,
+        lambda i: ("GET", f"/api/message/dmchannel/{CHANNEL}/messages", as_user(i)))
+    results.append(latest)
+
+    now = time.time()
+    history, _ = await drive("message_history", port, args.requests, args.concurrency, # Past the cache, straight to the DB.
+        lambda i: ("GET", f"/api/message/dmchannel/{CHANNEL}/messages?before_timestamp={now}&limit=100", as_user(i)))
+    results.append(history)
+
+    if args.clients > 0: # --clients 0 skips the fanout workload.
+        results.append(await fanout(port, users, args.clients, args.fanout_messages))
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port: int, server: subprocess.Popen, timeout: float = 30) -> None:
+    end = perf_counter() + timeout
+    while perf_counter() < end:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited during startup.")
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("The server did not start listening in time.")
+
+
+def report(results: list[Result]) -> list[dict]:
+    rows = [result.row() for result in results]
+    print(f"{'workload':<20} {'requests':>9} {'errors':>7} {'per sec':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for row in rows:
+        print(f"{row['workload']:<20} {row['requests']:>9} {row['errors']:>7} {row['per_second']:>9.1f} {row['p50_ms']:>8.2f} {row['p90_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end load test against in-process stand-ins for MariaDB and Redis.")
+    parser.add_argument("--users", type=int, default=32, help="users to create and log in (password hashing dominates)")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per message workload")
+    parser.add_argument("--concurrency", type=int, default=16, help="connections sending at once")
+    parser.add_argument("--clients", type=int, default=100, help="websockets connected for the fanout workload, 0 skips it")
+    parser.add_argument("--fanout-messages", type=int, default=50, help="messages sent to the fanout clients")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=JSON", help="override a config.json key")
+    parser.add_argument("--json", metavar="PATH", help="also write the results here")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory (DB, configs, server log)")
+    parser.add_argument("--serve", metavar="WORKDIR", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+
+    overrides = dict()
+    for item in args.set:
+        key, _, value = item.partition("=")
+        overrides[key] = loads(value)
+
+    workdir = tempfile.mkdtemp(prefix="razdor-load-")
+    write_configs(workdir, overrides)
+    port = free_port()
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.load", "--serve", workdir, "--port", str(port)], cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        asyncio.run(wait_for_port(port, server))
+        results = asyncio.run(run(args, port, workdir))
+    except Exception:
+        print(f"Server log: {log.name}")
+        args.keep = True
+        raise
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    rows = report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(dumps({"config": overrides, "args": {k: v for k, v in vars(args).items() if k not in ("serve", "port", "set")}, "results": rows}, indent=4))
+    if args.keep:
+        print(f"Working directory kept: {workdir}")
+
+
+if __name__ == '__main__':
+    main()
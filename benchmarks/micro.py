@@ -0,0 +1,311 @@
+# Microbenchmarks for the helpers every request or event goes through, with saved baselines so a change that slows
+# one of them down gets caught before it ships.
+# Run from the repo root:
+#   python -m benchmarks.micro [name ...]                                  run (names are prefixes) and print
+#   python -m benchmarks.micro --save baseline.json [name ...]             run and save the results as the baseline
+#   python -m benchmarks.micro --compare baseline.json [--tolerance 0.1]   run and exit 1 if anything regressed
+# Baselines only mean something on the machine and Python that made them, so none is shipped: save one on your
+# machine before changing anything, and compare against it after.
+import argparse
+import asyncio
+import os
+import platform
+import secrets
+import sys
+from datetime import datetime, timezone
+from inspect import iscoroutinefunction
+from json import dumps, loads
+from time import perf_counter
+from types import SimpleNamespace
+
+from sanic.response import HTTPResponse
+
+from blueprints import sse as sse_blueprint
+from models.events import Event
+from utils import checks, cors, id_generator
+from utils import db
+from utils.sse import SSE
+
+REPEAT = 5
+MIN_TIME = 0.1 # Seconds per repeat, loops are scaled up until one takes at least this long.
+RETRIES = 2 # Times a regression is measured again before --compare believes it, one noisy run shouldnt fail it.
+
+BENCHMARKS = dict() # name -> setup, which returns the function to time (sync or async, no arguments)
+
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def message_data(content: str) -> dict:
+    return {
+        "author": 1234567890123456789,
+        "id": 9876543210987654321,
+        "thread": 1122334455667788990,
+        "content": content,
+        "timestamp": 1690000000.123456
+    }
+
+
+def format_event(data: dict):
+    sse = SSE(asyncio.Queue(), None)
+    event = Event("new_message", 1, 1, "guild", data)
+    def run():
+        event.frame = None # Every event gets encoded once, time that and not the cached frame.
+        sse.format(event)
+    return run
+
+@benchmark("sse.format/message")
+def _():
+    return format_event(message_data("The quick brown fox jumps over the lazy dog. " * 4))
+
+@benchmark("sse.format/long_message")
+def _():
+    return format_event(message_data("The quick brown fox jumps over the lazy dog. " * 100))
+
+@benchmark("sse.format/cached")
+def _():
+    sse = SSE(asyncio.Queue(), None)
+    event = Event("new_message", 1, 1, "guild", message_data("The quick brown fox jumps over the lazy dog."))
+    sse.format(event)
+    return lambda: sse.format(event)
+
+
+class MemberDB: # Only answers the membership query, get_members caches what it returns.
+    def __init__(self, members: list[int]) -> None:
+        self.members = members
+
+    async def query(self, sql, destination):
+        return self.members
+
+
+class NullSocket:
+    async def send(self, frame):
+        pass
+
+    async def close(self):
+        pass
+
+
+def correct_connections(members: int, online: int):
+    sse = SSE(asyncio.Queue(), MemberDB(list(range(1, members + 1))))
+    for user_id in range(1, online + 1):
+        sse.conns.add(user_id, NullSocket())
+    async def run():
+        await sse.get_correct_connections(1, "guild", 1)
+    return run
+
+@benchmark("sse.get_correct_connections/dm_10_online_10")
+def _():
+    return correct_connections(10, 10)
+
+@benchmark("sse.get_correct_connections/guild_1000_online_50")
+def _():
+    return correct_connections(1000, 50)
+
+@benchmark("sse.get_correct_connections/guild_10000_online_5000")
+def _():
+    return correct_connections(10000, 5000)
+
+
+PAGE_SQL = "SELECT id, authorID, content, sent_timestamp FROM DMChannelmessages WHERE DMChannelID = ? ORDER BY sent_timestamp DESC, id DESC LIMIT ?"
+
+@benchmark("db.statement/cached")
+def _():
+    db.statement(PAGE_SQL)
+    return lambda: db.statement(PAGE_SQL) # What every query pays.
+
+@benchmark("db.statement/first_use")
+def _():
+    return lambda: db.Statement(PAGE_SQL) # What a statement pays once: map_col and the fingerprint.
+
+
+RAW_EVENT = 'event: new_message\ndata: {"destination": "guild:1122334455667788990", "author": "1234567890123456789", "content": "The quick brown fox jumps over the lazy dog."}'
+
+@benchmark("checks.is_valid_event")
+def _():
+    return lambda: checks.is_valid_event(RAW_EVENT)
+
+@benchmark("checks.authenticated")
+def _():
+    token = secrets.token_urlsafe(32)
+    given = token[:-1] + "x" # Worst case for compare_digest is a full length mismatch.
+    return lambda: checks.authenticated(given, token)
+
+
+@benchmark("blueprints.sse.format")
+def _():
+    return lambda: sse_blueprint.format(RAW_EVENT, 1234567890123456789)
+
+
+@benchmark("cors.add_cors_headers")
+def _():
+    request = SimpleNamespace(method="GET", route=SimpleNamespace(methods=frozenset(("GET", "POST"))))
+    response = HTTPResponse()
+    def run():
+        response.headers.clear() # Dont let the headers pile up between calls.
+        cors.add_cors_headers(request, response)
+    return run
+
+
+@benchmark("id_generator.generate_message_id")
+def _():
+    return id_generator.generate_message_id
+
+@benchmark("id_generator.generate_user_id")
+def _():
+    return id_generator.generate_user_id
+
+@benchmark("id_generator.generate_dm_id")
+def _():
+    return id_generator.generate_dm_id
+
+
+class DictRedis: # Just enough of a Redis client for session tokens, so we time the token and not a network.
+    def __init__(self) -> None:
+        self.data = dict()
+
+    async def set(self, key, value, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+@benchmark("id_generator.generate_session_token")
+def _():
+    redis = DictRedis()
+    async def run():
+        redis.data.clear() # Always a new login, never the reuse path.
+        await id_generator.generate_session_token(redis, 1234567890123456789)
+    return run
+
+
+def time_loops(fn, loops: int, loop) -> float:
+    if iscoroutinefunction(fn):
+        async def run():
+            start = perf_counter()
+            for _ in range(loops):
+                await fn()
+            return perf_counter() - start
+        return loop.run_until_complete(run())
+    start = perf_counter()
+    for _ in range(loops):
+        fn()
+    return perf_counter() - start
+
+
+def measure(fn, loop) -> float:
+    """ Nanoseconds per call, best of REPEAT runs. """
+    loops = 1
+    while (elapsed := time_loops(fn, loops, loop)) < MIN_TIME:
+        loops = max(loops * 2, int(loops * MIN_TIME * 1.2 / max(elapsed, 1e-9)))
+    return min(time_loops(fn, loops, loop) for _ in range(REPEAT)) / loops * 1e9
+
+
+def select(prefixes: list[str]) -> list[str]:
+    selected = [name for name in BENCHMARKS if not prefixes or any(name.startswith(prefix) for prefix in prefixes)]
+    if not selected:
+        raise SystemExit(f"No benchmark matches {', '.join(prefixes)}.")
+    return selected
+
+
+def run(selected: list[str]) -> dict[str, float]:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop) # Some setups make asyncio objects.
+    results = dict()
+    try:
+        for name in selected:
+            results[name] = measure(BENCHMARKS[name](), loop)
+            print(f"{name:<55} {results[name]:>12.1f} ns", flush=True)
+    finally:
+        loop.close()
+    return results
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(), "machine": platform.machine(), "platform": platform.platform()}
+
+
+def save(path: str, results: dict[str, float]) -> None:
+    with open(path, "w") as f:
+        f.write(dumps({
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "environment": environment(),
+            "ns_per_call": {name: round(ns, 1) for name, ns in results.items()}
+        }, indent=4) + "\n")
+    print(f"Saved {len(results)} results to {path}")
+
+
+def load(path: str) -> dict:
+    if not os.path.isfile(path):
+        raise SystemExit(f"No baseline at {path}, make one with --save {path} first.")
+    with open(path) as f:
+        return loads(f.read())
+
+
+def regressions(baseline: dict, results: dict[str, float], tolerance: float) -> list[str]:
+    return [name for name, now in results.items() if name in baseline["ns_per_call"] and now / baseline["ns_per_call"][name] - 1 > tolerance]
+
+
+def compare(baseline: dict, results: dict[str, float], tolerance: float) -> bool:
+    """ Prints every result against the baseline, returns whether anything got slower than tolerance allows. """
+    if baseline.get("environment") != environment():
+        print(f"Warning: the baseline was made on {baseline.get('environment')}, this is {environment()}. Expect noise.")
+    regressed = False
+    print(f"\n{'benchmark':<55} {'baseline ns':>12} {'now ns':>12} {'change':>8}")
+    for name, now in results.items():
+        before = baseline["ns_per_call"].get(name)
+        if before is None:
+            print(f"{name:<55} {'-':>12} {now:>12.1f} {'':>8}  new")
+            continue
+        change = now / before - 1
+        if change > tolerance:
+            verdict = "REGRESSED"
+            regressed = True
+        elif change < -tolerance:
+            verdict = "faster"
+        else:
+            verdict = ""
+        print(f"{name:<55} {before:>12.1f} {now:>12.1f} {change:>+7.1%}  {verdict}")
+    if regressed:
+        print(f"\nSlower than the baseline by more than {tolerance:.0%}, see above.")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks with saved baselines.")
+    parser.add_argument("names", nargs="*", help="only run benchmarks starting with these")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--save", metavar="PATH", help="save the results as the baseline")
+    mode.add_argument("--compare", metavar="PATH", help="compare against a baseline, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before --compare fails (default 0.1, 10%%)")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        return
+    baseline = load(args.compare) if args.compare else None # Before spending a minute measuring.
+    results = run(select(args.names))
+    if args.save:
+        save(args.save, results)
+    elif args.compare:
+        for _ in range(RETRIES):
+            suspects = regressions(baseline, results, args.tolerance)
+            if not suspects:
+                break
+            print(f"\nMeasuring {len(suspects)} possible regressions again.")
+            for name, now in run(suspects).items():
+                results[name] = min(results[name], now)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# In-process stand-ins for MariaDB and Redis, so the whole API can be benchmarked on a laptop.
+# The DB stand-in plugs SQLite connections into our own utils.pool.Pool, so statements, leasing, pool waits and
+# query stats all run the real code. Redis is fakeredis (pip install fakeredis lupa, lupa runs our Lua scripts)
+# behind the same instrumented client api.py uses.
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, _name TEXT, discrim TEXT, authentication TEXT, salt TEXT, created_at REAL);
+CREATE INDEX IF NOT EXISTS users_name ON users (_name, discrim);
+CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, authorID INTEGER, channelID INTEGER, DMChannelID INTEGER, userID INTEGER, content TEXT, sent_timestamp REAL);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channelID, sent_timestamp, id);
+CREATE TABLE IF NOT EXISTS DMmessages (id INTEGER PRIMARY KEY, authorID INTEGER, DmID INTEGER, content TEXT, sent_timestamp REAL);
+CREATE INDEX IF NOT EXISTS dmmessages_dm ON DMmessages (DmID, sent_timestamp, id);
+CREATE TABLE IF NOT EXISTS DMChannelmessages (id INTEGER PRIMARY KEY, authorID INTEGER, DMChannelID INTEGER, content TEXT, sent_timestamp REAL);
+CREATE INDEX IF NOT EXISTS dmchannelmessages_channel ON DMChannelmessages (DMChannelID, sent_timestamp, id);
+CREATE TABLE IF NOT EXISTS DMs (id INTEGER PRIMARY KEY, UserOneID INTEGER, UserTwoID INTEGER);
+CREATE INDEX IF NOT EXISTS dms_users ON DMs (UserOneID, UserTwoID);
+CREATE TABLE IF NOT EXISTS guildusers (parent_id INTEGER, user_id INTEGER);
+CREATE INDEX IF NOT EXISTS guildusers_parent ON guildusers (parent_id);
+CREATE INDEX IF NOT EXISTS guildusers_user ON guildusers (user_id);
+CREATE TABLE IF NOT EXISTS dmchannelusers (parent_id INTEGER, user_id INTEGER);
+CREATE INDEX IF NOT EXISTS dmchannelusers_parent ON dmchannelusers (parent_id);
+CREATE INDEX IF NOT EXISTS dmchannelusers_user ON dmchannelusers (user_id);
+CREATE TABLE IF NOT EXISTS friends (userOneID INTEGER, userTwoID INTEGER, start_timestamp REAL);
+CREATE TABLE IF NOT EXISTS pendingFriendRequests (outgoingUserID INTEGER, incomingUserID INTEGER, start_timestamp REAL);
+"""
+
+
+class SQLiteConnection:
+    """ The parts of a mariadb.Connection that utils.db uses. SQLite caches prepared statements itself. """
+    def __init__(self, path: str) -> None:
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False) # Autocommit, like our MariaDB connections.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def cursor(self, **kwargs):
+        return self.conn.cursor()
+
+    def begin(self) -> None: # Take the write lock up front, a deferred transaction that read first fails instead of waiting for it.
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self) -> None:
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+
+    def rollback(self) -> None:
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+
+    def ping(self) -> None:
+        self.conn.execute("SELECT 1")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def create_schema(path: str) -> None:
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.close()
+
+
+def sqlite_pool(path: str, size: int = 20):
+    from utils.pool import Pool
+    return Pool(lambda: SQLiteConnection(path), size=size, name="sqlite")
+
+
+def add_members(path: str, table: str, parent_id: int, user_ids: list[int]) -> None:
+    """ No API for joining guilds or DM channels yet, the benchmark writes membership straight into the DB. """
+    conn = sqlite3.connect(path, timeout=10)
+    conn.executemany(f"INSERT INTO {table} (parent_id, user_id) VALUES (?, ?)", [(parent_id, user_id) for user_id in user_ids])
+    conn.commit()
+    conn.close()
+
+
+def fake_redis():
+    """ Redis client like utils.redis.ARDB, talking to an in-process fakeredis server. """
+    import fakeredis
+    import fakeredis.aioredis
+    import redis.asyncio
+    from utils.redis import InstrumentedRedis
+    pool = redis.asyncio.ConnectionPool(connection_class=fakeredis.aioredis.FakeConnection, server=fakeredis.FakeServer(), decode_responses=True)
+    return InstrumentedRedis(connection_pool=pool)
@@ -0,0 +1,54 @@
+from sanic.blueprints import Blueprint
+from sanic.response import json, text
+
+from asyncio import get_running_loop, to_thread
+from secrets import compare_digest
+from threading import get_ident
+
+from sanic_ext import openapi
+
+from models import ops
+from utils import profiler, query_stats
+
+# Operational endpoints, only for whoever has the admin key from config.json. Not part of the public API.
+blueprint = Blueprint('Admin', url_prefix="/admin")
+
+MAX_PROFILE_SECONDS = 60
+
+
+def is_admin(request) -> bool:
+    admin_key = request.app.config.ADMIN_KEY
+    given = request.headers.authorization
+    if not admin_key or not given: # No key configured means nobody is an admin.
+        return False
+    return compare_digest(given.encode(), admin_key.encode())
+
+
+@blueprint.get("/profile", strict_slashes=True)
+@openapi.exclude()
+async def profile(request):
+    """ Samples this worker for `seconds` and returns collapsed stacks, ready for flamegraph.pl or speedscope. """
+    if not is_admin(request):
+        return json({"op": ops.Unauthorized.op}, status=401)
+
+    try:
+        seconds = min(max(float(request.args.get("seconds", 10)), 0.1), MAX_PROFILE_SECONDS)
+        interval = max(float(request.args.get("interval_ms", 5)), 1) / 1000
+    except ValueError:
+        return json({"op": ops.MissingRequiredJson.op}, status=400)
+    all_threads = request.args.get("threads") == "all" # DB and argon2 threads too, not just the event loop.
+
+    try: # The sampler gets its own thread, the loop keeps serving (and gets sampled) meanwhile.
+        stacks, taken = await to_thread(profiler.sample, get_running_loop(), get_ident(), seconds, interval, all_threads)
+    except profiler.ProfilerBusy:
+        return json({"op": ops.ProfilerBusy.op}, status=409)
+    return text(profiler.collapsed(stacks), headers={"X-Samples": str(taken)})
+
+
+@blueprint.get("/queries", strict_slashes=True)
+@openapi.exclude()
+async def queries(request):
+    """ Statement timings, the slow query log and the statements requests keep running over and over (N+1), for this worker. """
+    if not is_admin(request):
+        return json({"op": ops.Unauthorized.op}, status=401)
+    return json(query_stats.STATS.report())
@@ -10,6 +10,7 @@ from sanic_ext import openapi
 
 
 from datetime import datetime
+from math import isfinite
 
 # Create the main blueprint to work with
 blueprint = Blueprint('Message', url_prefix="/message")
@@ -18,15 +19,92 @@ valid_dest_types = { # TODO: change this to something less weird
     "dmchannel": "SELECT * FROM DMChannelmessages WHERE DMChannelID = ? AND id = ?",
     "channel":  "SELECT * FROM messages WHERE channelID = ? AND id = ?",
     "user":  "SELECT * FROM DMmessages WHERE DmID = ? AND id = ?",
-    "mass": {
-        "dmchannel": "SELECT * FROM DMChannelmessages WHERE DMChannelID = ? ORDER BY (`sent_timestamp`=0) DESC,`sent_timestamp` DESC LIMIT 100",
-        "channel":  "SELECT * FROM messages WHERE channelID = ? ORDER BY (`sent_timestamp`=0) DESC,`sent_timestamp` DESC LIMIT 100",
-        "user":  "SELECT * FROM DMmessages WHERE DmID = ? ORDER BY (`sent_timestamp`=0) DESC,`sent_timestamp` DESC LIMIT 100"
-    }
+    "mass": {}
 }
 
+# Message pages are keyed on (thread, sent_timestamp, id). Only snowflake IDs sort by send time, older rows have random
+# IDs, so the ID is just the tie breaker for messages sent in the same instant.
+# Every message table needs a composite index on (thread column, sent_timestamp, id) for these to stay cheap at any depth.
+# The ORs are spelled out instead of row comparisons, MariaDB only uses the index for them this way.
+def _page_queries(table: str, thread_column: str) -> dict:
+    base = f"SELECT id, authorID, content, sent_timestamp FROM {table} WHERE {thread_column} = ?" # Order matters, see format_message_row.
+    return {
+        "latest": f"{base} ORDER BY sent_timestamp DESC, id DESC LIMIT ?",
+        "before": f"{base} AND (sent_timestamp < ? OR (sent_timestamp = ? AND id < ?)) ORDER BY sent_timestamp DESC, id DESC LIMIT ?",
+        "after":  f"{base} AND (sent_timestamp > ? OR (sent_timestamp = ? AND id > ?)) ORDER BY sent_timestamp ASC, id ASC LIMIT ?",
+        "around": f"{base} AND (sent_timestamp < ? OR (sent_timestamp = ? AND id <= ?)) ORDER BY sent_timestamp DESC, id DESC LIMIT ?", # Paired with "after" for the newer half.
+        "position": f"SELECT sent_timestamp FROM {table} WHERE {thread_column} = ? AND id = ?" # Where an ID cursor sits.
+    }
+
+valid_dest_types["mass"]["dmchannel"] = _page_queries("DMChannelmessages", "DMChannelID")
+valid_dest_types["mass"]["channel"] = _page_queries("messages", "channelID")
+valid_dest_types["mass"]["user"] = _page_queries("DMmessages", "DmID")
+
+PAGE_LIMIT = 100 # Most messages a single page can return, also the default.
+cursors = ("before", "after", "around")
+BEFORE_ANY_ID = -1 # A timestamp cursor sits before every message sent at that time.
+
+def get_page_cursor(args) -> tuple[str, tuple|None, int]:
+    """ Reads the pagination query args: one of before/after/around as a message ID (or a unix timestamp with the _timestamp suffix) and a limit.
+    The position is (timestamp, id), the timestamp is None for an ID cursor until get_page looks it up. Raises ValueError on bad input. """
+    given = []
+    for cursor in cursors:
+        if cursor in args:
+            given.append((cursor, (None, int(args.get(cursor)))))
+        if f"{cursor}_timestamp" in args:
+            timestamp = float(args.get(f"{cursor}_timestamp"))
+            if not isfinite(timestamp): # float() takes nan and inf, neither compares to a sent_timestamp.
+                raise ValueError("Timestamp has to be finite.")
+            given.append((cursor, (timestamp, BEFORE_ANY_ID)))
+    if len(given) > 1:
+        raise ValueError("Only one cursor can be given.")
+    limit = int(args.get("limit", PAGE_LIMIT))
+    if not 1 <= limit <= PAGE_LIMIT:
+        raise ValueError("Limit out of range.")
+    if not given:
+        return "latest", None, limit
+    return given[0][0], given[0][1], limit
+
+async def get_page(db, queries: dict, thread_id: int, cursor: str, position: tuple|None, limit: int) -> list[tuple]:
+    """ A page of message rows, always newest first. Rows are tuples, a history page can be 100 of them. """
+    if cursor == "latest":
+        return await db.query_tuples(queries["latest"], thread_id, limit)
+    timestamp, _id = position
+    if timestamp is None:
+        found = await db.query_tuples(queries["position"], thread_id, _id)
+        if not found: # Not a message in this thread.
+            return []
+        timestamp = found[0][0]
+    match cursor:
+        case "before":
+            return await db.query_tuples(queries["before"], thread_id, timestamp, timestamp, _id, limit)
+        case "after":
+            return (await db.query_tuples(queries["after"], thread_id, timestamp, timestamp, _id, limit))[::-1]
+        case "around": # The message itself and older ones get the bigger half.
+            newer = await db.query_tuples(queries["after"], thread_id, timestamp, timestamp, _id, limit // 2)
+            older = await db.query_tuples(queries["around"], thread_id, timestamp, timestamp, _id, limit - len(newer))
+            return newer[::-1] + older
+
 user_dest_check = "SELECT id FROM DMs WHERE (UserOneID = ? AND UserTwoID = ?) or (UserTwoID = ? AND UserOneID = ?)"
 
+def format_message(msg: dict, thread_id: int) -> dict: # DB row -> what clients (and the message cache) get.
+    return {
+        "id": msg['id'],
+        "author": msg['authorID'],
+        "thread": thread_id,
+        "content": msg['content'],
+        "timestamp": msg['sent_timestamp']
+    }
+
+def format_message_row(row: tuple, thread_id: int) -> dict: # Same, from a (id, authorID, content, sent_timestamp) page row.
+    return {
+        "id": row[0],
+        "author": row[1],
+        "thread": thread_id,
+        "content": row[2],
+        "timestamp": row[3]
+    }
+
 @blueprint.get("/<thread_type:str>/<thread_id:int>/get/<message_id:int>", strict_slashes=True, ignore_body=False)
 @openapi.body({"application/json": {"requester": int}})
 @openapi.description("Fetches a message from a channel or DM.")
@@ -35,7 +113,7 @@ user_dest_check = "SELECT id FROM DMs WHERE (UserOneID = ? AND UserTwoID = ?) or
 @openapi.response(400, {"application/json" : ops.MissingJson})
 @openapi.response(400, {"application/json" : {"op": "Invalid thread type."}}) # TODO: convert to ops formatting like normal.
 @openapi.response(404, {"application/json" : ops.Void})
-def message_get(request, thread_type, thread_id, message_id):
+async def message_get(request, thread_type, thread_id, message_id):
     db = request.ctx.db
 
     _json = request.json
@@ -52,30 +130,21 @@ def message_get(request, thread_type, thread_id, message_id):
     # TODO: CHECK IF USER CAN GET MESSAGES
 
     if thread_type == "user":
-        check = db.query_row(user_dest_check, thread_id, _json["requester"], thread_id, _json["requester"])
-        if not check: # Dms dont exist
+        dest = await db.query_row(user_dest_check, thread_id, _json["requester"], thread_id, _json["requester"])
+        if not dest: # Dms dont exist
             return json({"op": ops.Void.op}, status=404)
-
-        data = db.query_row(query, check, message_id) 
     else:
-        data = db.query_row(query, thread_id, message_id)
+        dest = thread_id
+
+    cached = await request.ctx.message_cache.find(thread_type, dest, message_id) # Most reads are for recent messages.
+    if cached:
+        return json(cached, status=200)
 
+    data = await db.query_row(query, dest, message_id)
     if not data:
         return json({"op": ops.Void.op}, status=404)
 
-
-    if check:
-        dest = check
-    else:
-        dest = thread_id
-
-    return json({
-            "id": data['id'],
-            "author":data['authorID'],
-            "thread": dest,
-            "content": data['content'],
-            "timestamp": data['sent_timestamp']
-        }, status=200)
+    return json(format_message(data, dest), status=200)
 
 
 @blueprint.delete("/<thread_type:str>/<thread_id:int>/delete/<message_id:int>", strict_slashes=True)
@@ -86,7 +155,7 @@ def message_get(request, thread_type, thread_id, message_id):
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(404, {"application/json" : ops.Void})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def message_delete(request, thread_type, thread_id, message_id):
+async def message_delete(request, thread_type, thread_id, message_id):
     db = request.ctx.db
 
     if thread_type not in valid_dest_types:
@@ -97,23 +166,24 @@ def message_delete(request, thread_type, thread_id, message_id):
     if not _json:
         return json({"op": ops.MissingJson.op})
 
-    if not all(k in data for k in ("requester", "auth")):
+    if not all(k in _json for k in ("requester", "auth")):
         return json({"op": ops.MissingRequiredJson.op})
 
     if thread_type == "user":
-        data = db.query_row(query, thread_id, thread_id, message_id) # TODO/BUG: unknown behavior, it is giving it the same ID for UserOne and UserTwo, might need to require a requester (author) ID for this.
+        data = await db.query_row(query, thread_id, thread_id, message_id) # TODO/BUG: unknown behavior, it is giving it the same ID for UserOne and UserTwo, might need to require a requester (author) ID for this.
     else:
-        data = db.query_row(query, thread_id, message_id)
+        data = await db.query_row(query, thread_id, message_id)
     if not data:
         return json({"op": ops.Void.op}, status=404)
 
 
-    if not checks.authenticated(_json["auth"], id_generator.get_session_token(request.ctx.redis, _json['requester'])): # Client is trying to delete a message as a user they are not.
+    if not checks.authenticated(_json["auth"], await id_generator.get_session_token(request.ctx.sessions, _json['requester'])): # Client is trying to delete a message as a user they are not.
         return json({"op": ops.Unauthorized.op}, status=401)
 
 
 
-    db.execute("DELETE FROM messages WHERE id = ?", message_id)
+    await db.execute("DELETE FROM messages WHERE id = ?", message_id)
+    await request.ctx.message_cache.invalidate(thread_type, thread_id)
     return json({"op": ops.Deleted.op}, status=200)
 
 
@@ -139,39 +209,41 @@ async def message_send(request, thread_type, thread_id):
     if not all(k in data for k in ("requester","content", "auth")):
         return json({"op": ops.MissingRequiredJson.op})
 
-    if not checks.authenticated(request.json["auth"], id_generator.get_session_token(request.ctx.redis, data['requester'])): # Client is trying to send a message as a user they are not, or their auth is wrong.
+    if not checks.authenticated(request.json["auth"], await id_generator.get_session_token(request.ctx.sessions, data['requester'])): # Client is trying to send a message as a user they are not, or their auth is wrong.
         return json({"op": ops.Unauthorized.op}, status=401)
 
-    _id = id_generator.generate_message_id(db) # Generate the ID
+    _id = id_generator.generate_message_id() # Generate the ID
 
     timestamp = datetime.now().timestamp()
     check = None
 
     if thread_type == "dmchannel": # TODO: make sure they exist outside of just the user thread type
-         db.execute("INSERT INTO DMChannelmessages (id, authorID, DMChannelID, content, sent_timestamp) VALUES (?,?,?,?,?)", _id, data['requester'], thread_id, data['content'], timestamp)
+         await request.ctx.writes.insert(db, "INSERT INTO DMChannelmessages (id, authorID, DMChannelID, content, sent_timestamp) VALUES (?,?,?,?,?)", _id, data['requester'], thread_id, data['content'], timestamp)
     elif thread_type == "user":
-        if not checks.user_exists(db, thread_id): # User has to exist
+        if not await checks.user_exists(db, thread_id): # User has to exist
             return json({"op": ops.Void.op}, status=404)
-        check = db.query_row(user_dest_check, thread_id, data["requester"], thread_id, data["requester"])
+        check = await db.query_row(user_dest_check, thread_id, data["requester"], thread_id, data["requester"])
         if not check: # Dms dont exist, make them.
-            dm_id = id_generator.generate_dm_id(db)
-            db.execute("INSERT INTO DMs (id, UserOneID, UserTwoID) VALUES (?,?,?)", dm_id, data['requester'], thread_id)
+            check = id_generator.generate_dm_id()
+            await db.execute("INSERT INTO DMs (id, UserOneID, UserTwoID) VALUES (?,?,?)", check, data['requester'], thread_id)
 
-        db.execute("INSERT INTO DMmessages (id, authorID, DmID, content, sent_timestamp) VALUES (?,?,?,?,?)", _id, data['requester'], check, data['content'], timestamp)
+        await request.ctx.writes.insert(db, "INSERT INTO DMmessages (id, authorID, DmID, content, sent_timestamp) VALUES (?,?,?,?,?)", _id, data['requester'], check, data['content'], timestamp)
     elif thread_type == "guild":
-        db.execute("INSERT INTO messages (id, authorID, channelID, content, sent_timestamp) VALUES (?,?,?,?,?)", _id, data['requester'], thread_id, data['content'], timestamp)
+        await request.ctx.writes.insert(db, "INSERT INTO messages (id, authorID, channelID, content, sent_timestamp) VALUES (?,?,?,?,?)", _id, data['requester'], thread_id, data['content'], timestamp)
     if check:
         thread_id = check
-
-    await request.ctx.sse.register_event(events.Event("new_message", int(data['requester']), thread_id, thread_type,
-        {
-            "author": data['requester'],
-            "id": _id,
-            "thread": thread_id,
-            "content": data['content'],
-            "timestamp": timestamp
-        }
-    ))
+    db.note_write() # The insert went through the write buffer, the author still has to read it back.
+
+    msg = {
+        "id": _id,
+        "author": int(data['requester']),
+        "thread": thread_id,
+        "content": data['content'],
+        "timestamp": timestamp
+    }
+    if thread_type in ("dmchannel", "user", "guild"): # Write through (only what got stored), so the thread stays cached.
+        await request.ctx.message_cache.push(thread_type, thread_id, msg)
+    await request.ctx.sse.register_event(events.Event("new_message", int(data['requester']), thread_id, thread_type, msg))
     return json(
         {"op": ops.Sent.op},
         status=200
@@ -180,14 +252,19 @@ async def message_send(request, thread_type, thread_id):
 
 @blueprint.get("/<thread_type:str>/<thread_id:int>/messages", strict_slashes=True, ignore_body=False)
 @openapi.body({"application/json": {"auth": str, "requester": int}})
-@openapi.description("Fetches messages from a channel or DM.")
+@openapi.description("Fetches messages from a channel or DM, newest first. Page through history with one of before/after/around (message ID) or before_timestamp/after_timestamp/around_timestamp (unix time).")
+@openapi.parameter(name="before", schema=int, location="query")
+@openapi.parameter(name="after",  schema=int, location="query")
+@openapi.parameter(name="around", schema=int, location="query")
+@openapi.parameter(name="limit",  schema=int, location="query")
 @openapi.response(400, {"application/json" : {"op": "Invalid thread type."}}) # TODO: convert to ops formatting like normal.
 @openapi.response(200, {"application/json" : {"msgs": list[message.Message]}})
 @openapi.response(400, {"application/json" : ops.MissingJson})
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
+@openapi.response(400, {"application/json" : ops.InvalidPage})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
 @openapi.response(404, {"application/json" : ops.Void})
-def message_mass_get(request, thread_type, thread_id):
+async def message_mass_get(request, thread_type, thread_id):
     db = request.ctx.db
     if thread_type not in valid_dest_types["mass"]:
         return json({"op": "Invalid thread type."})
@@ -198,35 +275,35 @@ def message_mass_get(request, thread_type, thread_id):
     if not all(k in data for k in ("requester", "auth")):
         return json({"op": ops.MissingRequiredJson.op})
 
-    if not checks.authenticated(request.json["auth"], id_generator.get_session_token(request.ctx.redis, request.json["requester"])): # Client is trying to send a message as a user they are not, or their auth is wrong.
+    try:
+        cursor, position, limit = get_page_cursor(request.args)
+    except ValueError:
+        return json({"op": ops.InvalidPage.op}, status=400)
+
+    if not checks.authenticated(request.json["auth"], await id_generator.get_session_token(request.ctx.sessions, request.json["requester"])): # Client is trying to send a message as a user they are not, or their auth is wrong.
         return json({"op": ops.Unauthorized.op}, status=401)
 
     # TODO: CHECK IF USER CAN GET MESSAGES
 
     if thread_type == "user":
-        check = db.query_row(user_dest_check, thread_id, data["requester"], thread_id, data["requester"])
+        check = await db.query_row(user_dest_check, thread_id, data["requester"], thread_id, data["requester"])
         if not check: # Dms dont exist
             return json({"op": ops.Void.op}, status=404)
 
-        _data = db.query(valid_dest_types["mass"][thread_type], check)
-    else:
-        check = None
-        _data = db.query(valid_dest_types["mass"][thread_type], thread_id)
-
-    if not _data:
-        return json({"op": ops.Void.op}, status=404)
+        thread_id = check
 
-    messages = []
-    for msg in _data:
-        if check:
-            thread_id = check
-        messages.append({
-            "id": msg['id'],
-            "author": msg['authorID'],
-            "thread": thread_id,
-            "content": msg['content'],
-            "timestamp": msg['sent_timestamp']
-        })
+    cache = request.ctx.message_cache
+    if cursor == "latest" and limit <= cache.capacity: # Opening a thread, the cache has the newest messages of recently used threads.
+        messages = await cache.latest(thread_type, thread_id, limit)
+        if messages is None:
+            version = await cache.version(thread_type, thread_id)
+            _data = await get_page(db, valid_dest_types["mass"][thread_type], thread_id, cursor, position, cache.capacity)
+            messages = [format_message_row(row, thread_id) for row in _data]
+            await cache.fill(thread_type, thread_id, version, messages, len(_data) < cache.capacity)
+            messages = messages[:limit]
+    else:
+        _data = await get_page(db, valid_dest_types["mass"][thread_type], thread_id, cursor, position, limit)
+        messages = [format_message_row(row, thread_id) for row in _data]
 
     if len(messages) == 0:
         return json({"op": ops.Void.op}, status=404)
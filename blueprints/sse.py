@@ -48,17 +48,18 @@ def format(raw_event_data, conn_ref: int, delim: str = "\n"): # This code is wac
 @openapi.parameter(name="Authorization", schema=str, location="header", required=True)
 @openapi.parameter(name="Author",        schema=str, location="header", required=True)
 async def ws_recv(request, ws):
+    conn = None
     try:
         if not request.headers.author or not request.headers.authorization or not request.headers: # Doesnt have the required headers.
             return await close(ws, "error: missing headers") # Missing headers
 
         given_auth_token, user_id = request.headers.authorization, request.headers.author
-        real_auth_token = checks.ws_auth(request.ctx.redis, user_id, given_auth_token)
+        real_auth_token = await checks.ws_auth(request.ctx.sessions, user_id, given_auth_token)
 
         if not real_auth_token: # Token does not exist, or is wrong.
             return await close(ws, "error: authentication error")
 
-        await request.ctx.sse.register(int(user_id), ws) # Register the client for outgoing events under their auth token.
+        conn = await request.ctx.sse.register(int(user_id), ws) # Register the client for outgoing events, every device they connect gets its own connection.
         await ws.send("recognized") # let the client know they are registered.
         while True:
             raw_event_data = await ws.recv() # Connection has sent a new event.
@@ -77,10 +78,10 @@ async def ws_recv(request, ws):
                         elif event.destination_type == "guild":
                             query = "INSERT INTO messages (id, authorID, channelID, content, sent_timestamp) VALUES (?,?,?,?,?)"
 
-                        _id = id_generator.generate_message_id(request.ctx.db) # Generate the UID 
+                        _id = id_generator.generate_message_id() # Generate the UID 
                         timestamp = datetime.now().timestamp()
 
-                        request.ctx.db.execute(query, _id, user_id, event.data["thread"], event.data["content"], timestamp)
+                        await request.ctx.writes.insert(request.ctx.db, query, _id, user_id, event.data["thread"], event.data["content"], timestamp)
                     await request.ctx.sse.register_event(event) # Put the new event in the queue to send to other connections.
                 except FormatError as e:
                     await ws.send(Event("error", -1, {"error": f"{e.message}"}))
@@ -90,6 +91,7 @@ async def ws_recv(request, ws):
     except ConnectionClosed:
         pass
     finally:
-        await request.ctx.sse.unregister(int(user_id)) # Unregister the client.
+        if conn is not None:
+            await request.ctx.sse.unregister(conn) # Unregister this connection, their other devices stay.
 
 openapi.exclude(ws_recv)
@@ -13,15 +13,20 @@ blueprint = Blueprint('User', url_prefix="/user")
 
 import time
 
+async def rehash_if_needed(request, user_id, password_plaintext, password_hash): # The argon2 settings changed since this hash was made, upgrade it while we have the password.
+    if request.ctx.hasher.needs_rehash(password_hash):
+        password_obj = await request.ctx.hasher.hash_password(password_plaintext)
+        await request.ctx.db.execute("UPDATE users SET authentication = ?, salt = ? WHERE id = ?", password_obj.hash, password_obj.salt, user_id)
+
 @blueprint.get("/<thread_id:int>", strict_slashes=True)
 @openapi.summary("User get")
 @openapi.description("Fetches user information.")
 @openapi.response(200, {"application/json" : user.User})
 @openapi.response(404, {"application/json" : ops.Void})
-def user_get(request, thread_id):
+async def user_get(request, thread_id):
     db = request.ctx.db
 
-    data = db.query_row("SELECT id, _name, discrim FROM users WHERE id = ?" , thread_id) # TODO: logic for if you can get the users information.
+    data = await db.query_row("SELECT id, _name, discrim FROM users WHERE id = ?" , thread_id) # TODO: logic for if you can get the users information.
     if not data:
         return json({"op": ops.Void.op}, status=404)
     return json({
@@ -39,7 +44,8 @@ def user_get(request, thread_id):
 @openapi.response(400, {"application/json" : ops.MissingJson})
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_create(request):
+@openapi.response(409, {"application/json" : ops.DiscriminatorsExhausted})
+async def user_create(request):
     db = request.ctx.db
 
     data = request.json
@@ -49,12 +55,18 @@ def user_create(request):
     if not all(k in data for k in ("username","password")):
         return json({"op": ops.MissingRequiredJson.op})
 
-    _id = id_generator.generate_user_id(db)
-    _discrim = id_generator.generate_user_discrim(db, data["username"])
-
-    password_obj = request.ctx.hasher.hash_password(data['password']) 
-
-    db.execute("INSERT INTO users (id, _name, discrim, authentication, salt, created_at) VALUES (?,?,?,?,?,?)" , _id, data["username"], _discrim, password_obj.hash, password_obj.salt, time.time())
+    _id = id_generator.generate_user_id()
+    try:
+        _discrim = await id_generator.generate_user_discrim(db, request.ctx.redis, data["username"])
+    except id_generator.DiscriminatorsExhausted:
+        return json({"op": ops.DiscriminatorsExhausted.op}, status=409)
+
+    try: # From here on, anything that stops the user being created has to give the discriminator back (HasherBusy too).
+        password_obj = await request.ctx.hasher.hash_password(data['password'])
+        await db.execute("INSERT INTO users (id, _name, discrim, authentication, salt, created_at) VALUES (?,?,?,?,?,?)" , _id, data["username"], _discrim, password_obj.hash, password_obj.salt, time.time())
+    except BaseException: # Cancelled requests too.
+        await id_generator.release_user_discrim(request.ctx.redis, data["username"], _discrim)
+        raise
     return json({"op": ops.UserCreated.op, "id": _id}, status=200) # BUG?: I am getting the wrong ID returned from the Docs. Check if reproducable?
 
 @blueprint.post("/<thread_id:int>/add", strict_slashes=True) # TODO: add support for username
@@ -66,7 +78,7 @@ def user_create(request):
 @openapi.response(400, {"application/json" : ops.MissingJson})
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_friend_add(request, thread_id):
+async def user_friend_add(request, thread_id):
     db = request.ctx.db
     receiver = thread_id # For readability 
 
@@ -80,10 +92,10 @@ def user_friend_add(request, thread_id):
     if int(requester) == thread_id:
         return json({"op": "Error. Not lonely enough to send friend requests to self"}) # we do a little trolling
 
-    if not checks.authenticated(auth, id_generator.get_session_token(request.ctx.redis, requester)): # The client is trying to send a request without auth.
+    if not checks.authenticated(auth, await id_generator.get_session_token(request.ctx.sessions, requester)): # The client is trying to send a request without auth.
         return json({"op": ops.Unauthorized.op}, status=401)
 
-    db.execute("INSERT INTO pendingFriendRequests (outgoingUserID, incomingUserID, start_timestamp) VALUES (?,?,?)", requester, receiver, time.time())
+    await db.execute("INSERT INTO pendingFriendRequests (outgoingUserID, incomingUserID, start_timestamp) VALUES (?,?,?)", requester, receiver, time.time())
     return json({"op": ops.Sent.op}, status=200)
 
 @blueprint.post("/<thread_id:int>/relationships", strict_slashes=True)
@@ -94,7 +106,7 @@ def user_friend_add(request, thread_id):
 @openapi.response(400, {"application/json" : ops.MissingJson})
 @openapi.response(404, {"application/json" : ops.Void})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_relationships(request, thread_id):
+async def user_relationships(request, thread_id):
     db = request.ctx.db
     user = thread_id # For readability 
 
@@ -105,12 +117,12 @@ def user_relationships(request, thread_id):
         return json({"op": ops.MissingJson.op})
     auth = data['auth']
 
-    if not checks.authenticated(auth, id_generator.get_session_token(request.ctx.redis, user)):
+    if not checks.authenticated(auth, await id_generator.get_session_token(request.ctx.sessions, user)):
         return json({"op": "unauthorized."}, status=401)
 
 
-    friends = db.query("SELECT userOneID,userTwoID FROM friends WHERE (userOneID = ? OR userTwoID = ?)", user, user)
-    pending = db.query("SELECT outgoingUserID FROM pendingFriendRequests WHERE incomingUserID = ?", user)
+    friends = await db.query("SELECT userOneID,userTwoID FROM friends WHERE (userOneID = ? OR userTwoID = ?)", user, user)
+    pending = await db.query("SELECT outgoingUserID FROM pendingFriendRequests WHERE incomingUserID = ?", user)
     relationships = {}
     for x in pending: relationships[x] = "pending"
     for result in friends:
@@ -130,7 +142,7 @@ def user_relationships(request, thread_id):
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(404, {"application/json" : ops.Void})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_friend_accept(request):
+async def user_friend_accept(request):
     db = request.ctx.db
 
     data = request.json
@@ -140,18 +152,18 @@ def user_friend_accept(request):
         return json({"op": ops.MissingRequiredJson.op})
     auth, requester, parent = data['auth'], data['requester'], data['parent']
 
-    if not checks.authenticated(auth, id_generator.get_session_token(request.ctx.redis, parent)):
+    if not checks.authenticated(auth, await id_generator.get_session_token(request.ctx.sessions, parent)):
         return json({"op": ops.Unauthorized.op}, status=401)
 
 
-    check = db.query("SELECT outgoingUserID FROM pendingFriendRequests WHERE incomingUserID = ? AND outgoingUserID = ?", parent, requester)
+    check = await db.query("SELECT outgoingUserID FROM pendingFriendRequests WHERE incomingUserID = ? AND outgoingUserID = ?", parent, requester)
     if not check: # The friend request doesnt exist
         return json({"op": ops.Void.op}, status=404)
-    check = db.query("SELECT * FROM friends WHERE (userOneID = ? AND userTwoID = ?)", parent, requester)
+    check = await db.query("SELECT * FROM friends WHERE (userOneID = ? AND userTwoID = ?)", parent, requester)
     if check:
         return json({"op": ops.AlreadyAdded})
-    db.execute("INSERT INTO friends (userOneID, userTwoID, start_timestamp) VALUES (?,?,?)", parent, requester, time.time())
-    db.execute("DELETE FROM pendingFriendRequests WHERE incomingUserID = ? AND outgoingUserID = ?", parent, requester)
+    await db.execute("INSERT INTO friends (userOneID, userTwoID, start_timestamp) VALUES (?,?,?)", parent, requester, time.time())
+    await db.execute("DELETE FROM pendingFriendRequests WHERE incomingUserID = ? AND outgoingUserID = ?", parent, requester)
     return json({"op": ops.Done.op}, status=200)
 
 @blueprint.delete("/<thread_id:int>/delete", strict_slashes=True)
@@ -162,7 +174,8 @@ def user_friend_accept(request):
 @openapi.response(400, {"application/json" : ops.MissingJson})
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_delete(request, thread_id):
+@openapi.response(404, {"application/json" : ops.Void})
+async def user_delete(request, thread_id):
     db = request.ctx.db
     user = thread_id # For readability 
 
@@ -174,10 +187,18 @@ def user_delete(request, thread_id):
         return json({"op": ops.MissingRequiredJson.op})
 
 
-    if not checks.authenticated(data["auth"], id_generator.get_session_token(request.ctx.redis, user)):
+    if not checks.authenticated(data["auth"], await id_generator.get_session_token(request.ctx.sessions, user)):
         return json({"op": ops.Unauthorized.op}, status=401)
 
-    db.execute("DELETE FROM users WHERE id = ?", user)
+    name = await db.query_row("SELECT _name, discrim FROM users WHERE id = ?", user)
+    if not name:
+        return json({"op": ops.Void.op}, status=404)
+    await db.execute("DELETE FROM users WHERE id = ?", user)
+    await id_generator.release_user_discrim(request.ctx.redis, name["_name"], name["discrim"])
+    await id_generator.revoke_session_token(request.ctx.redis, user)
+    request.ctx.sse.invalidate_member(user) # They wont be in any destination anymore.
+    if request.ctx.sse.broker is not None:
+        await request.ctx.sse.broker.members_changed(user_id=user)
     return json({"op": ops.Deleted.op}, status=200)
 
 
@@ -190,7 +211,7 @@ def user_delete(request, thread_id):
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(404, {"application/json" : ops.Void})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_authkey_id(request, user_id):
+async def user_authkey_id(request, user_id):
     db = request.ctx.db
     user = user_id # For readability 
     _json = request.json
@@ -200,17 +221,18 @@ def user_authkey_id(request, user_id):
     if not "auth" in _json:
         return json({"op": ops.MissingRequiredJson.op})
 
-    data = db.query_row("SELECT id, authentication, salt, created_at FROM users WHERE id = ?" , user)
+    data = await db.query_row("SELECT id, authentication, salt, created_at FROM users WHERE id = ?" , user)
     if not data:
         return json({"op": ops.Void.op}, status=404) # it doesnt exist
 
-    check = request.ctx.hasher.verify_password_hash(_json['auth'], data['authentication'], data['salt']) # Verify their password is correct.
+    check = await request.ctx.hasher.verify_password_hash(_json['auth'], data['authentication'], data['salt']) # Verify their password is correct.
 
     if check != True: # the hash doesnt match
         return json({"op": ops.Unauthorized.op}, status=401)
     
     elif check == True: # the hash matches
-        key = id_generator.generate_session_token(request.ctx.redis, user)
+        await rehash_if_needed(request, data['id'], _json['auth'], data['authentication'])
+        key = await id_generator.generate_session_token(request.ctx.redis, user)
         return json({"op": ops.UserAuthkeyCreated.op, "id": data['id'], "authentication": key})
 
 @blueprint.post("/<username:str>/<discriminator:str>/authkey", strict_slashes=True) # TODO: make one endpoint
@@ -222,7 +244,7 @@ def user_authkey_id(request, user_id):
 @openapi.response(400, {"application/json" : ops.MissingRequiredJson})
 @openapi.response(404, {"application/json" : ops.Void})
 @openapi.response(401, {"application/json" : ops.Unauthorized})
-def user_authkey(request, username, discriminator):
+async def user_authkey(request, username, discriminator):
     db = request.ctx.db
     _json = request.json
     if not _json:
@@ -231,15 +253,16 @@ def user_authkey(request, username, discriminator):
     if not "auth" in _json:
         return json({"op": ops.MissingRequiredJson.op})
 
-    data = db.query_row("SELECT id, authentication, salt, created_at FROM users WHERE _name = ? AND discrim = ?" , username, discriminator)
+    data = await db.query_row("SELECT id, authentication, salt, created_at FROM users WHERE _name = ? AND discrim = ?" , username, discriminator)
     if not data:
         return json({"op": ops.Void.op}, status=404) # it doesnt exist
 
-    check = request.ctx.hasher.verify_password_hash(_json['auth'], data['authentication'], data['salt']) # Verify their password is correct.
+    check = await request.ctx.hasher.verify_password_hash(_json['auth'], data['authentication'], data['salt']) # Verify their password is correct.
 
     if check != True: # the hash doesnt match
         return json({"op": ops.Unauthorized.op}, status=401)
     
     elif check == True: # the hash matches
-        key = id_generator.generate_session_token(request.ctx.redis, data['id'])
+        await rehash_if_needed(request, data['id'], _json['auth'], data['authentication'])
+        key = await id_generator.generate_session_token(request.ctx.redis, data['id'])
         return json({"op": ops.UserAuthkeyCreated.op, "id": data['id'], "authentication": key})
\ No newline at end of file
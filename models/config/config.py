@@ -2,5 +2,23 @@
 schema = {
     "selfhosting" :              {"type": "boolean"},
     "api_landing_page":          {"type": "boolean"},
-    "api_landing_page_location": {"type": "string"}
+    "api_landing_page_location": {"type": "string"},
+    "node_id":                   {"type": "integer", "minimum": 0, "maximum": 31},
+    "message_cache_messages":    {"type": "integer", "minimum": 1},
+    "message_cache_threads":     {"type": "integer", "minimum": 1},
+    "session_cache_size":        {"type": "integer", "minimum": 1},
+    "session_cache_ttl":         {"type": "number", "minimum": 0},
+    "argon2":                    {"type": "object"}, # Passed straight to argon2.PasswordHasher, changing it rehashes passwords as users log in.
+    "hash_threads":              {"type": "integer", "minimum": 1},
+    "hash_max_waiting":          {"type": "integer", "minimum": 0},
+    "event_broker":              {"type": "boolean"},
+    "connection_queue_size":     {"type": "integer", "minimum": 1},
+    "slow_consumer_policy":      {"enum": ["drop", "coalesce", "disconnect"]},
+    "db_request_transaction":    {"type": "boolean"},
+    "metrics":                   {"type": "boolean"},
+    "slow_query_ms":             {"type": "number", "minimum": 0},
+    "n_plus_one_threshold":      {"type": "integer", "minimum": 2},
+    "admin_key":                 {"type": "string"}, # Authorization header for /admin, leave it empty to turn admin routes off.
+    "tracing":                   {"type": "object"}, # enabled, sample_rate (0-1), exporter (file/memory), path, keep
+    "write_behind":              {"type": "object"} # enabled, max_batch, max_delay (seconds), ack (flush/immediate)
 }
\ No newline at end of file
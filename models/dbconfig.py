@@ -7,4 +7,8 @@ class DBConfig:
     user: str
     password: str
     database: str
-    pool_size = 20
\ No newline at end of file
+    pool_size = 20
+    pool_overflow = 0 # Extra connections for bursts, closed again when the burst is over
+    pool_max_waiting = 64 # Requests allowed to wait for a connection before we start turning them away
+    pool_timeout = 5.0 # Seconds to wait for a connection
+    pool_ping_interval = 30.0 # Idle connections older than this get pinged
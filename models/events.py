@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 
 
@@ -9,6 +9,9 @@ class Event:
     destination: int
     destination_type: str 
     data: dict | None = None
+    frame: str | None = field(default=None, init=False, repr=False, compare=False) # Encoded once by SSE.format, shared by every recipient.
+    trace: tuple | None = field(default=None, init=False, repr=False, compare=False) # (trace ID, span ID) of the request that sent it, if it was traced.
+    queued_at: float | None = field(default=None, init=False, repr=False, compare=False) # Unix time it was handed off, for delivery latency.
 
 @dataclass
 class Heartbeat:
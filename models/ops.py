@@ -32,6 +32,18 @@ class Done:
 class AlreadyAdded:
     op = "Already added."
 
+@dataclass
+class InvalidPage:
+    op = "Invalid page, give at most one of before/after/around and a limit between 1 and 100."
+
+@dataclass
+class DiscriminatorsExhausted:
+    op = "No discriminators left for this username."
+
+@dataclass
+class ProfilerBusy:
+    op = "A profile is already running on this worker."
+
 
 
 @dataclass
@@ -0,0 +1,43 @@
+import pytest
+
+from utils.db import DB
+from utils.pool import Pool
+
+
+class FailingCursor:
+    def execute(self, sql, args):
+        raise RuntimeError("statement failed")
+
+    def executemany(self, sql, rows):
+        raise RuntimeError("statement failed")
+
+    def close(self):
+        pass
+
+
+class FailingConnection: # Every statement and every begin fails.
+    def cursor(self, **kwargs):
+        return FailingCursor()
+
+    def begin(self):
+        raise RuntimeError("begin failed")
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_failures_give_connections_back():
+    pool = Pool(FailingConnection, size=2, timeout=0.1)
+    db = DB(pool)
+    calls = (lambda: db.execute("INSERT INTO x VALUES (?)", 1), lambda: db.executemany("INSERT INTO x VALUES (?)", [(1,)]), db.begin, lambda: db.lease(True))
+    for call in calls:
+        for _ in range(pool.size + 1): # One more than the pool holds, a leak would time out here.
+            with pytest.raises(RuntimeError):
+                call()
+    assert pool.stats()["in_use"] == 0
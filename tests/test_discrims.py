@@ -0,0 +1,52 @@
+import asyncio
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from utils import id_generator
+
+
+class UsersDB: # Answers the discriminator query from a list of taken ones.
+    def __init__(self, taken: list[str]) -> None:
+        self.taken = taken
+
+    async def query(self, sql, username):
+        return self.taken
+
+
+def make_redis():
+    return fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+
+
+def test_new_username_stays_small():
+    async def run():
+        redis = make_redis()
+        assert await id_generator.generate_user_discrim(UsersDB([]), redis, "alice") == "0001"
+        assert await redis.strlen(id_generator._discrim_key("alice")) == 1
+        assert 0 < await redis.ttl(id_generator._discrim_key("alice")) <= id_generator.DISCRIM_TTL
+    asyncio.run(run())
+
+
+def test_skips_taken_and_reuses_released():
+    async def run():
+        redis = make_redis()
+        db = UsersDB(["0001", "0003"])
+        assert await id_generator.generate_user_discrim(db, redis, "bob") == "0002"
+        assert await id_generator.generate_user_discrim(db, redis, "bob") == "0004"
+        await id_generator.release_user_discrim(redis, "bob", "0002")
+        assert await id_generator.generate_user_discrim(db, redis, "bob") == "0002"
+        await redis.delete(id_generator._discrim_key("bob")) # Expired, seeded from the DB again.
+        db.taken += ["0002", "0004"]
+        assert await id_generator.generate_user_discrim(db, redis, "bob") == "0005"
+    asyncio.run(run())
+
+
+def test_exhausted():
+    async def run():
+        redis = make_redis()
+        db = UsersDB([id_generator.format_discrim(x) for x in range(id_generator.DISCRIM_MIN, id_generator.DISCRIM_MAX)])
+        assert await id_generator.generate_user_discrim(db, redis, "carol") == "9999"
+        with pytest.raises(id_generator.DiscriminatorsExhausted):
+            await id_generator.generate_user_discrim(db, redis, "carol")
+    asyncio.run(run())
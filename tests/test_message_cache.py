@@ -0,0 +1,53 @@
+import asyncio
+
+import fakeredis
+import fakeredis.aioredis
+
+from utils.message_cache import MessageCache
+
+
+def make_cache() -> MessageCache:
+    return MessageCache(fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True), capacity=3)
+
+
+def message(_id: int) -> dict:
+    return {"id": _id, "author": 1, "thread": 7, "content": f"message {_id}", "timestamp": 1690000000.0 + _id}
+
+
+def test_send_into_empty_thread_shows_up_in_latest():
+    async def run():
+        cache = make_cache()
+        assert await cache.latest("dmchannel", 7, 3) is None
+        assert await cache.fill("dmchannel", 7, await cache.version("dmchannel", 7), [], complete=True) # Empty thread, as the GET caches it.
+        assert await cache.latest("dmchannel", 7, 3) == []
+        await cache.push("dmchannel", 7, message(1))
+        assert await cache.latest("dmchannel", 7, 3) == [message(1)]
+    asyncio.run(run())
+
+
+def test_push_skips_threads_that_are_not_cached():
+    async def run():
+        cache = make_cache()
+        await cache.push("dmchannel", 7, message(1))
+        assert await cache.latest("dmchannel", 7, 3) is None
+    asyncio.run(run())
+
+
+def test_push_keeps_capacity_newest_first():
+    async def run():
+        cache = make_cache()
+        assert await cache.fill("dmchannel", 7, await cache.version("dmchannel", 7), [message(2), message(1)], complete=True)
+        for _id in (3, 4):
+            await cache.push("dmchannel", 7, message(_id))
+        assert await cache.latest("dmchannel", 7, 3) == [message(4), message(3), message(2)]
+    asyncio.run(run())
+
+
+def test_fill_after_a_write_is_dropped():
+    async def run():
+        cache = make_cache()
+        version = await cache.version("dmchannel", 7)
+        await cache.push("dmchannel", 7, message(1)) # Lands while the fill was reading the DB.
+        assert not await cache.fill("dmchannel", 7, version, [], complete=True)
+        assert await cache.latest("dmchannel", 7, 3) is None
+    asyncio.run(run())
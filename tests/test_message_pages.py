@@ -0,0 +1,75 @@
+import asyncio
+import random
+import sqlite3
+
+import pytest
+
+from blueprints.message import get_page, get_page_cursor, valid_dest_types
+from utils import id_generator
+
+QUERIES = valid_dest_types["mass"]["dmchannel"]
+
+
+class SQLiteDB: # query_tuples is all get_page needs.
+    def __init__(self) -> None:
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE DMChannelmessages (id INTEGER PRIMARY KEY, authorID INTEGER, DMChannelID INTEGER, content TEXT, sent_timestamp REAL)")
+
+    async def query_tuples(self, sql, *args):
+        return self.conn.execute(sql, args).fetchall()
+
+
+def make_thread() -> tuple[SQLiteDB, list[int]]:
+    """ 30 old messages with random IDs, then 30 with snowflakes, two of them sent at the same time. Returns IDs oldest first. """
+    db = SQLiteDB()
+    rng = random.Random(7)
+    ids = []
+    for n in range(60):
+        _id = rng.getrandbits(63) if n < 30 else id_generator.generate_message_id()
+        timestamp = 1600000000.0 + (n if n != 45 else 44) # 44 and 45 share a timestamp.
+        db.conn.execute("INSERT INTO DMChannelmessages VALUES (?, 1, 7, ?, ?)", (_id, f"message {n}", timestamp))
+        ids.append(_id)
+    return db, ids
+
+
+def page(db, args: dict) -> list[int]:
+    cursor, position, limit = get_page_cursor(args)
+    return [row[0] for row in asyncio.run(get_page(db, QUERIES, 7, cursor, position, limit))]
+
+
+def test_latest_page_is_newest_by_send_time():
+    db, ids = make_thread()
+    assert page(db, {"limit": "10"}) == ids[::-1][:10]
+
+
+def test_before_cursor_walks_every_message_once():
+    db, ids = make_thread()
+    seen = page(db, {"limit": "7"})
+    while True:
+        older = page(db, {"before": str(seen[-1]), "limit": "7"})
+        if not older:
+            break
+        seen += older
+    assert seen == ids[::-1]
+
+
+def test_after_and_around_cursors():
+    db, ids = make_thread()
+    assert page(db, {"after": str(ids[43]), "limit": "3"}) == [ids[46], ids[45], ids[44]]
+    assert page(db, {"around": str(ids[20]), "limit": "4"}) == [ids[22], ids[21], ids[20], ids[19]]
+
+
+def test_timestamp_cursor():
+    db, ids = make_thread()
+    assert page(db, {"before_timestamp": "1600000010", "limit": "2"}) == [ids[9], ids[8]]
+
+
+def test_unknown_cursor_message_is_an_empty_page():
+    db, ids = make_thread()
+    assert page(db, {"before": "12345"}) == []
+
+
+def test_non_finite_timestamp_is_rejected():
+    for value in ("nan", "inf", "-inf"):
+        with pytest.raises(ValueError):
+            get_page_cursor({"before_timestamp": value})
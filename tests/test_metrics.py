@@ -0,0 +1,22 @@
+from utils.metrics import Registry
+
+
+def test_read_counter_renders_as_counter():
+    registry = Registry()
+    hits = {"hit": 3, "miss": 1}
+    registry.read_counter("session_cache_lookups_total", "Session cache lookups.", lambda: {(result,): count for result, count in hits.items()}, ("result",))
+    assert registry.render() == (
+        "# HELP session_cache_lookups_total Session cache lookups.\n"
+        "# TYPE session_cache_lookups_total counter\n"
+        'session_cache_lookups_total{result="hit"} 3\n'
+        'session_cache_lookups_total{result="miss"} 1\n'
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram("wait_seconds", "Waits.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == ['wait_seconds_bucket{le="0.1"} 1', 'wait_seconds_bucket{le="1.0"} 2', 'wait_seconds_bucket{le="+Inf"} 3', "wait_seconds_sum 5.55", "wait_seconds_count 3"]
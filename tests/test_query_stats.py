@@ -0,0 +1,14 @@
+from utils.query_stats import QueryStats
+
+
+def test_report_has_slow_and_repeated_statements():
+    stats = QueryStats(slow_seconds=0.1, n_plus_one=3)
+    stats.begin_request("/api/v1/message/mass_get")
+    for _ in range(3):
+        stats.record("SELECT x FROM y WHERE id = ?", 0.001)
+    stats.record("SELECT * FROM z", 0.5)
+    stats.end_request()
+    report = stats.report()
+    assert [entry["fingerprint"] for entry in report["statements"]] == ["SELECT * FROM z", "SELECT x FROM y WHERE id = ?"]
+    assert report["slow"] == [{"route": "/api/v1/message/mass_get", "seconds": 0.5, "fingerprint": "SELECT * FROM z"}]
+    assert report["repeated"] == [{"route": "/api/v1/message/mass_get", "fingerprint": "SELECT x FROM y WHERE id = ?", "requests": 1}]
@@ -0,0 +1,65 @@
+import asyncio
+from json import loads
+
+from models.events import Event
+from utils.registry import OutboundPolicy
+from utils.sse import SSE
+
+
+class MemberDB: # Only answers the membership query.
+    def __init__(self, members: list[int]) -> None:
+        self.members = members
+
+    async def query(self, sql, destination):
+        return self.members
+
+
+class FastSocket:
+    def __init__(self) -> None:
+        self.frames = []
+        self.closed = False
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def close(self):
+        self.closed = True
+
+
+class StuckSocket(FastSocket):
+    async def send(self, frame):
+        await asyncio.Event().wait() # The client stopped reading.
+
+
+async def burst(socket, events: int, policy: OutboundPolicy) -> SSE:
+    sse = SSE(asyncio.Queue(), MemberDB([1]), outbound=policy)
+    await sse.register(1, socket)
+    for number in range(events):
+        sse.queue.put_nowait(Event("new_message", 2, 1, "guild", {"content": number}))
+    loop = asyncio.create_task(sse.event_push_loop())
+    for _ in range(1000):
+        await asyncio.sleep(0)
+        if sse.queue.empty() and len(socket.frames) == events:
+            break
+    loop.cancel()
+    return sse
+
+
+def test_burst_bigger_than_the_queue_reaches_a_fast_client():
+    async def run():
+        policy = OutboundPolicy() # 256 frames, disconnect
+        socket = FastSocket()
+        await burst(socket, 300, policy)
+        assert len(socket.frames) == 300
+        assert [loads(frame.split("data: ", 1)[1])["content"] for frame in socket.frames] == list(range(300)) # In order, none lost.
+        assert policy.disconnected == 0 and not socket.closed
+    asyncio.run(run())
+
+
+def test_stuck_client_is_still_disconnected():
+    async def run():
+        policy = OutboundPolicy(queue_size=8)
+        socket = StuckSocket()
+        await burst(socket, 50, policy)
+        assert policy.disconnected == 1 and socket.closed
+    asyncio.run(run())
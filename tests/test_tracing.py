@@ -0,0 +1,30 @@
+from json import loads
+from multiprocessing import get_context
+
+from utils.tracing import FileExporter, Span
+
+SPANS = 2000
+
+
+def export_spans(path: str, worker: int, start) -> None:
+    exporter = FileExporter(path)
+    start.wait() # All at once, so their writes overlap.
+    for n in range(SPANS):
+        span = Span("a" * 32, None, "db", "CLIENT", {"worker": worker, "statement": "SELECT x FROM y WHERE z = ?" * 100})
+        span.duration = 0.001
+        exporter.export(span)
+    exporter.close()
+
+
+def test_workers_sharing_a_file_write_whole_lines(tmp_path):
+    path = str(tmp_path / "traces.jsonl")
+    context = get_context("fork")
+    start = context.Barrier(4)
+    workers = [context.Process(target=export_spans, args=(path, worker, start)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    with open(path) as f:
+        spans = [loads(line) for line in f] # A line cut in half or mixed with another would not parse.
+    assert sorted(span["tags"]["worker"] for span in spans) == sorted(str(worker) for worker in range(4) for _ in range(SPANS))
@@ -0,0 +1,109 @@
+from asyncio import Lock, sleep
+from json import dumps, loads
+
+from models.events import Event
+from utils.db import AsyncDB
+
+# Cross worker (and cross node) event delivery over Redis pub/sub.
+# Every destination gets its own channel, a worker only subscribes to the destinations its online users are in,
+# so an event is only ever shipped to workers that have someone to give it to.
+
+MEMBERS_CHANNEL = "events:members" # Membership changed somewhere, drop it from every worker's index.
+
+
+class EventBroker:
+    def __init__(self, redis_conn, sse, db: AsyncDB) -> None:
+        self.redis = redis_conn # redis.asyncio client
+        self.sse = sse
+        self.db = db
+        self.pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+        self.lock = Lock() # Subscription bookkeeping, users come and go while we wait on the DB.
+        self.subscriptions = dict() # channel -> how many local users need it
+        self.user_channels = dict() # user ID -> channels subscribed for them
+
+    @staticmethod
+    def channel(destination_type: str, destination) -> str:
+        return f"events:{destination_type}:{int(destination)}"
+
+    async def publish(self, event: Event) -> None:
+        payload = dumps({
+            "event": event.event,
+            "conn_ref": event.conn_ref,
+            "destination": int(event.destination),
+            "destination_type": event.destination_type,
+            "frame": self.sse.format(event), # Encoded once here, receiving workers dont need to again.
+            "trace": event.trace,
+            "queued_at": event.queued_at
+        })
+        await self.redis.publish(self.channel(event.destination_type, event.destination), payload)
+
+    async def members_changed(self, destination_type: str | None = None, destination: int | None = None, user_id: int | None = None) -> None:
+        """ Tell every worker (this one included) that a destination's members, or everything a user is in, changed. """
+        await self.redis.publish(MEMBERS_CHANNEL, dumps({"destination_type": destination_type, "destination": destination, "user_id": user_id}))
+
+    async def destinations(self, user_id: int) -> list[str]:
+        guilds = await self.db.query("SELECT parent_id FROM guildusers WHERE user_id = ?", user_id)
+        dmchannels = await self.db.query("SELECT parent_id FROM dmchannelusers WHERE user_id = ?", user_id)
+        return [self.channel("user", user_id)] + [self.channel("guild", x) for x in guilds] + [self.channel("dmchannel", x) for x in dmchannels]
+
+    async def user_online(self, user_id: int) -> None:
+        channels = await self.destinations(user_id)
+        async with self.lock:
+            if user_id in self.user_channels or user_id not in self.sse.conns: # Already subscribed for them, or they left while we were looking.
+                return
+            self.user_channels[user_id] = channels
+            new = []
+            for channel in channels:
+                self.subscriptions[channel] = self.subscriptions.get(channel, 0) + 1
+                if self.subscriptions[channel] == 1:
+                    new.append(channel)
+            if new:
+                await self.pubsub.subscribe(*new)
+
+    async def user_offline(self, user_id: int) -> None:
+        async with self.lock:
+            unused = []
+            for channel in self.user_channels.pop(user_id, ()):
+                self.subscriptions[channel] -= 1
+                if self.subscriptions[channel] == 0:
+                    del self.subscriptions[channel]
+                    unused.append(channel)
+            if unused:
+                await self.pubsub.unsubscribe(*unused)
+
+    async def refresh_user(self, user_id: int) -> None: # They joined or left something while online.
+        if user_id in self.user_channels:
+            await self.user_offline(user_id)
+            await self.user_online(user_id)
+
+    async def handle(self, message: dict) -> None:
+        data = loads(message["data"])
+        if message["channel"] == MEMBERS_CHANNEL:
+            if data["user_id"] is not None:
+                self.sse.invalidate_member(data["user_id"])
+                await self.refresh_user(data["user_id"])
+            else:
+                self.sse.invalidate_members(data["destination_type"], data["destination"])
+            return
+        event = Event(data["event"], data["conn_ref"], data["destination"], data["destination_type"])
+        event.frame = data["frame"]
+        event.trace = tuple(data["trace"]) if data.get("trace") else None
+        event.queued_at = data.get("queued_at")
+        await self.sse.queue.put(event) # The push loop only hands it to our own connections.
+
+    async def listen(self) -> None:
+        print("Starting event broker.")
+        await self.pubsub.subscribe(MEMBERS_CHANNEL)
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        await self.handle(message)
+                    except Exception as e:
+                        print(f"Error handling broker message\n{e}")
+            except Exception as e: # Lost Redis, the client reconnects and subscribes to everything again on the next read.
+                print(f"Event broker error\n{e}")
+                self.sse.invalidate_members() # We might have missed membership changes.
+                await sleep(1)
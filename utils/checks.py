@@ -10,8 +10,8 @@ valid_events = {
     "user_edit"
 }
 
-def user_exists(db_conn, given_id: int):
-    check = db_conn.query_row("SELECT id FROM users WHERE id=?", given_id)
+async def user_exists(db_conn, given_id: int):
+    check = await db_conn.query_row("SELECT id FROM users WHERE id=?", given_id)
     if not check: # user doesnt exist
         return False
     else:
@@ -22,9 +22,8 @@ def authenticated(given_auth_key: bytearray, real_auth_key: bytearray): # Helper
     return compare_digest(given_auth_key, real_auth_key)
     
 
-def check_impersonation(redis_conn, given_author_id, real_author_id): # fresh from my ass, legacy code, i was high as fuck writing this and i dont even know where i was going
-    real_token = redis_conn.get(real_author_id)
-    check_token = redis_conn.get(given_author_id)
+async def check_impersonation(redis_conn, given_author_id, real_author_id): # fresh from my ass, legacy code, i was high as fuck writing this and i dont even know where i was going
+    real_token, check_token = await redis_conn.mget(real_author_id, given_author_id) # One round trip for both.
     if not real_token or not check_token:
         return None
     matches = compare_digest(real_token, check_token)
@@ -39,8 +38,8 @@ def has_shared_or_is_friend(db_conn): # You cannot get user info for a user you
 
 ## THIS IS LEGACY CODE, YOU SHOULD BE USING THE GOLANG WS SERVER ##
 
-def ws_auth(redis_conn, given_author_id, given_auth_token):
-    real_token = redis_conn.get(given_author_id)
+async def ws_auth(redis_conn, given_author_id, given_auth_token): # redis_conn can also be a session_cache.SessionCache
+    real_token = await redis_conn.get(given_author_id)
     if not real_token: # The user has not authenticated. Possible impersonation. (they used a random ID/TOKEN, account is not logged in.)
         return None, False
     matches = compare_digest(given_auth_token, real_token)
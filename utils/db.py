@@ -1,29 +1,47 @@
+from asyncio import Lock, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from dataclasses import dataclass
+from functools import partial
+from itertools import cycle
 import json
+from time import perf_counter
 from typing import Sequence
 import mariadb
 import re
 from models.dbconfig import DBConfig
+from utils.pool import Pool, PoolTimeout
+from utils import query_stats, tracing
 
 DB_CONFIG_PATH = 'server_data/db.json' # TODO: replace db.json with a more general config.json format
 
 
 
-def mariadb_pool(pool_id: int) -> mariadb.ConnectionPool:
-  f = json.load(open(DB_CONFIG_PATH))
+def db_config() -> dict:
+  with open(DB_CONFIG_PATH) as f:
+    return json.load(f)
+
+def mariadb_pool(pool_id: int, replica: dict|None = None, name: str = '') -> Pool:
+  f = db_config()
+  if replica is not None: # Replicas only need a host, everything else defaults to the primary's.
+    f = {k: v for k, v in f.items() if k != 'replicas'} | replica
   config = DBConfig(
     user=f['user'],
     password=f['password'],
     database=f['database'])
   # Set optional config values
-  def set_opt(key: str, t: type):
-    if key in f and type(f[key]) is t:
-      config[key] = f[key]
+  def set_opt(key: str, *types: type):
+    if key in f and type(f[key]) in types:
+      setattr(config, key, f[key])
   set_opt('host', str)
   set_opt('port', int)
   set_opt('pool_size', int)
+  set_opt('pool_overflow', int)
+  set_opt('pool_max_waiting', int)
+  set_opt('pool_timeout', int, float)
+  set_opt('pool_ping_interval', int, float)
 
-  return mariadb.ConnectionPool(
+  return Pool(partial(mariadb.connect,
     host=config.host,
     port=config.port,
     database=config.database,
@@ -31,18 +49,46 @@ def mariadb_pool(pool_id: int) -> mariadb.ConnectionPool:
     user=config.user,
     password=config.password,
 
-    pool_size=config.pool_size,
-    pool_name=f'pool_{config.database}{pool_id}')
+    autocommit=True), # Transactions are always explicit (begin), so a connection never goes back with a read snapshot open.
+    size=config.pool_size,
+    overflow=config.pool_overflow,
+    max_waiting=config.pool_max_waiting,
+    timeout=config.pool_timeout,
+    ping_interval=config.pool_ping_interval,
+    name=f'pool_{config.database}{pool_id}{name}')
+
+def replica_pools(pool_id: int) -> list[Pool]:
+  """ Read replicas listed under "replicas" in db.json, none is fine. """
+  return [mariadb_pool(pool_id, replica, f'_replica{n}') for n, replica in enumerate(db_config().get('replicas', []))]
+
+class Statement:
+  """ What we work out from the SQL text, done once per distinct statement instead of on every row. """
+  __slots__ = ('sql', 'map_col', 'fingerprint')
+
+  def __init__(self, sql: str):
+    self.sql = sql
+    self.map_col = DBConnection.map_col(sql) # Single column queries return bare values instead of dicts.
+    self.fingerprint = query_stats.fingerprint(sql) # What its timings are filed under.
+
+statements: dict[str, Statement] = dict() # SQL text -> Statement, the SQL all lives in the code so this stays small.
+MAX_STATEMENTS = 1024 # Just in case someone starts building SQL strings on the fly.
+
+def statement(sql: str) -> Statement:
+  stmt = statements.get(sql)
+  if stmt is None:
+    stmt = Statement(sql)
+    if len(statements) < MAX_STATEMENTS:
+      statements[sql] = stmt
+  return stmt
 
 class DBConnection:
   conn: mariadb.Connection
-  cur: mariadb.Cursor
+  cursors: dict[str, mariadb.Cursor]
   autoclose = False
 
-  def __init__(self, pool: mariadb.ConnectionPool, autoclose: bool|None):
+  def __init__(self, pool: Pool, autoclose: bool|None):
     self.conn = pool.get_connection()
-    self.cur = self.conn.cursor(
-      dictionary=True)
+    self.cursors = dict() # SQL -> prepared cursor, running the same statement again on this connection skips the prepare.
     if autoclose is not None:
       self.autoclose = autoclose
 
@@ -55,59 +101,354 @@ class DBConnection:
       map_col = re_result.groups()[0]
     return map_col
 
-  def query_row(self, query: str, *args) -> dict|str:
-    self.cur.execute(query, args)
-    result = self.cur.fetchone()
-    map_col = self.map_col(query)
-    if result is not None and map_col is not None:
-      result = result[map_col]
-    if self.autoclose:
+  def cursor(self, sql: str) -> mariadb.Cursor:
+    cur = self.cursors.get(sql)
+    if cur is None:
+      cur = self.cursors[sql] = self.conn.cursor(prepared=True)
+    return cur
+
+  def close(self) -> None: # Hands the connection back to the pool.
+    try:
+      for cur in self.cursors.values():
+        cur.close()
+    finally: # Even if the connection died under its cursors, the pool still needs it back.
+      self.cursors.clear()
       self.conn.close()
-    return result
-  
+
+  def run(self, sql: str, args: Sequence, fetch):
+    try:
+      cur = self.cursor(sql)
+      fingerprint = statement(sql).fingerprint
+      with tracing.span("db", "CLIENT", statement=fingerprint):
+        start = perf_counter()
+        cur.execute(sql, args)
+        result = fetch(cur)
+      query_stats.STATS.record(fingerprint, perf_counter() - start)
+      return result
+    finally:
+      if self.autoclose:
+        self.close()
+
+  @staticmethod
+  def columns(description) -> tuple[str]:
+    return tuple(column[0] for column in description)
+
+  def query_row(self, query: str, *args) -> dict|str:
+    row, description = self.run(query, args, lambda cur: (cur.fetchone(), cur.description))
+    if row is None:
+      return None
+    if statement(query).map_col is not None:
+      return row[0]
+    return dict(zip(self.columns(description), row))
+
   def query(self, query: str, *args) -> list[dict]:
-    self.cur.execute(query, args)
-    result = list()
-    for row in self.cur:
-      map_col = self.map_col(query)
-      if row is not None and map_col is not None:
-        row = row[map_col]
-      result.append(row)
-    if self.autoclose:
-      self.conn.close()
-    return result
+    rows, description = self.run(query, args, lambda cur: (cur.fetchall(), cur.description))
+    if statement(query).map_col is not None:
+      return [row[0] for row in rows]
+    columns = self.columns(description) # Once per query, not per row.
+    return [dict(zip(columns, row)) for row in rows]
+
+  def query_tuples(self, query: str, *args) -> list[tuple]: # For hot queries that dont need dicts, columns come in SELECT order.
+    return self.run(query, args, lambda cur: cur.fetchall())
 
   def execute(self, stmt: str, *args) -> None:
-    self.cur.execute(stmt, args)
-    if self.autoclose:
-      self.conn.close()
+    self.run(stmt, args, lambda cur: None)
+
+  def executemany(self, stmt: str, rows: Sequence[tuple]) -> None:
+    try:
+      cur = self.cursor(stmt)
+      fingerprint = statement(stmt).fingerprint
+      with tracing.span("db", "CLIENT", statement=fingerprint, rows=len(rows)):
+        start = perf_counter()
+        cur.executemany(stmt, rows)
+      query_stats.STATS.record(fingerprint, perf_counter() - start)
+    finally:
+      if self.autoclose:
+        self.close()
 
   def begin(self) -> None:
     self.conn.begin()
-  def rollback(self) -> None:
-    self.conn.rollback()
-    self.conn.close()
-  def commit(self) -> None: # Closes the connection
+  def rollback(self, close: bool = True) -> None:
+    try:
+      self.conn.rollback()
+    finally:
+      if close:
+        self.close()
+  def commit(self, close: bool = True) -> None: # Closes the connection unless told otherwise
     self.conn.commit()
-    self.conn.close()
+    if close:
+      self.close()
 
 class DB:
-  pool: mariadb.ConnectionPool
-  def __init__(self, pool: mariadb.ConnectionPool):
+  """ Writes and transactions go to the primary pool, plain reads are spread over the replicas (if there are any). """
+  pool: Pool
+  replicas: list[Pool]
+  def __init__(self, pool: Pool, replicas: list[Pool]|None = None):
     self.pool = pool
+    self.replicas = replicas or []
+    self.next_replica = cycle(self.replicas).__next__ if self.replicas else None
 
-  def query_row(self, query: str, *args) -> dict:
-    return DBConnection(self.pool, True).query_row(query, *args)
+  def reader(self, autoclose: bool) -> DBConnection:
+    if self.next_replica is not None:
+      try:
+        return DBConnection(self.next_replica(), autoclose)
+      except (PoolTimeout, mariadb.OperationalError): # Replica down or out of connections, the primary can take it.
+        pass
+    return DBConnection(self.pool, autoclose)
 
-  def query(self, query: str, *args) -> list[dict]:
-    return DBConnection(self.pool, True).query(query, *args)
+  def query_row(self, query: str, *args, primary: bool = False) -> dict: # primary: the read has to see our own writes.
+    return (DBConnection(self.pool, True) if primary else self.reader(True)).query_row(query, *args)
+
+  def query(self, query: str, *args, primary: bool = False) -> list[dict]:
+    return (DBConnection(self.pool, True) if primary else self.reader(True)).query(query, *args)
+
+  def query_tuples(self, query: str, *args, primary: bool = False) -> list[tuple]:
+    return (DBConnection(self.pool, True) if primary else self.reader(True)).query_tuples(query, *args)
 
   def execute(self, stmt: str, *args) -> None:
     conn = DBConnection(self.pool, False)
-    conn.execute(stmt, *args)
-    conn.commit()
+    try:
+      conn.execute(stmt, *args)
+      conn.commit(close=False)
+    except:
+      conn.rollback(close=False)
+      raise
+    finally: # Our pool has no finalizer, a connection that isnt closed is gone for good.
+      conn.close()
+
+  def executemany(self, stmt: str, rows: Sequence[tuple]) -> None: # All rows in one transaction, one commit.
+    conn = self.begin()
+    try:
+      conn.executemany(stmt, rows)
+      conn.commit(close=False)
+    except:
+      conn.rollback(close=False)
+      raise
+    finally:
+      conn.close()
 
   def begin(self) -> DBConnection:
     conn = DBConnection(self.pool, False)
-    conn.begin()
+    try:
+      conn.begin()
+    except: # Only closed if it failed, otherwise the caller owns it.
+      conn.rollback()
+      raise
+    return conn
+
+  def lease(self, transaction: bool = False, primary: bool = True) -> DBConnection:
+    conn = DBConnection(self.pool, False) if primary else self.reader(False)
+    if transaction:
+      try:
+        conn.begin()
+      except:
+        conn.rollback()
+        raise
     return conn
+
+class AsyncDBConnection:
+  """ Async wrapper around a DBConnection, every call runs on the AsyncDB executor. """
+  def __init__(self, adb: 'AsyncDB', conn: DBConnection):
+    self.adb = adb
+    self.conn = conn
+
+  async def query_row(self, query: str, *args) -> dict|str:
+    return await self.adb.run(self.conn.query_row, query, *args)
+
+  async def query(self, query: str, *args) -> list[dict]:
+    return await self.adb.run(self.conn.query, query, *args)
+
+  async def query_tuples(self, query: str, *args) -> list[tuple]:
+    return await self.adb.run(self.conn.query_tuples, query, *args)
+
+  async def execute(self, stmt: str, *args) -> None:
+    return await self.adb.run(self.conn.execute, stmt, *args)
+
+  async def executemany(self, stmt: str, rows: Sequence[tuple]) -> None:
+    return await self.adb.run(self.conn.executemany, stmt, rows)
+
+  async def rollback(self) -> None:
+    return await self.adb.run(self.conn.rollback)
+  async def commit(self) -> None: # Closes the connection
+    return await self.adb.run(self.conn.commit)
+
+class AsyncDB:
+  """ Same surface as DB, but the blocking connector calls run on a thread pool so they never stall the event loop.
+  There is a thread for every connection plus every place in the pools' wait lines. Leased connections are held between
+  queries, so threads waiting on a pool must never be able to starve the requests that hold its connections. """
+  db: DB
+  executor: ThreadPoolExecutor
+  def __init__(self, db: DB, max_workers: int|None = None):
+    self.db = db
+    self.executor = ThreadPoolExecutor(
+      max_workers=max_workers or sum(pool.max_size + pool.max_waiting for pool in self.pools),
+      thread_name_prefix='db')
+
+  @property
+  def pool(self) -> Pool:
+    return self.db.pool
+
+  @property
+  def pools(self) -> list[Pool]:
+    return [self.db.pool] + self.db.replicas
+
+  async def run(self, func, *args, **kwargs): # In a copy of our context, so query stats know which request it was for.
+    return await get_running_loop().run_in_executor(self.executor, copy_context().run, partial(func, *args, **kwargs))
+
+  async def query_row(self, query: str, *args, primary: bool = False) -> dict:
+    return await self.run(self.db.query_row, query, *args, primary=primary)
+
+  async def query(self, query: str, *args, primary: bool = False) -> list[dict]:
+    return await self.run(self.db.query, query, *args, primary=primary)
+
+  async def query_tuples(self, query: str, *args, primary: bool = False) -> list[tuple]:
+    return await self.run(self.db.query_tuples, query, *args, primary=primary)
+
+  async def execute(self, stmt: str, *args) -> None:
+    return await self.run(self.db.execute, stmt, *args)
+
+  async def executemany(self, stmt: str, rows: Sequence[tuple]) -> None:
+    return await self.run(self.db.executemany, stmt, rows)
+
+  async def begin(self) -> AsyncDBConnection:
+    return AsyncDBConnection(self, await self.run(self.db.begin))
+
+  def note_write(self) -> None: # Nothing to route here, see LeasedDB.
+    pass
+
+  async def keep_alive(self) -> None:
+    """ Pings idle connections in the background so dead ones are gone before a request gets them. """
+    interval = min(pool.ping_interval for pool in self.pools)
+    while True:
+      await sleep(interval)
+      for pool in self.pools:
+        try:
+          await self.run(pool.check)
+        except Exception as e:
+          print(f"DB health check failed for {pool.name}\n{e}")
+
+  def stats(self) -> dict:
+    return {pool.name: pool.stats() for pool in self.pools}
+
+  def close(self) -> None:
+    self.executor.shutdown(wait=True)
+    for pool in self.pools:
+      pool.close()
+
+class Stickiness:
+  """ Read your writes: for a little while after a user writes, their reads skip the replicas so they never see
+  the past. Kept in Redis so it holds whichever worker their next request lands on. """
+  def __init__(self, redis_conn, window: float = 2.0):
+    self.redis = redis_conn # redis.asyncio client
+    self.window = window # Seconds, comfortably more than replication lag.
+
+  @staticmethod
+  def key(user_id) -> str:
+    return f"dbsticky:{int(user_id)}"
+
+  async def wrote(self, user_id) -> None:
+    await self.redis.set(self.key(user_id), 1, px=int(self.window * 1000))
+
+  async def is_sticky(self, user_id) -> bool:
+    return bool(await self.redis.exists(self.key(user_id)))
+
+class LeasedDB:
+  """ Same surface as AsyncDB, for a single request. Connections are checked out on first use, every query the
+  handler makes shares them, and release() hands them back once the response is out.
+  Reads lease a replica connection, writes a primary one. Once the request writes, or if the user wrote a moment ago,
+  its reads go to the primary too. With transaction=True everything is on the primary and the whole request is one
+  transaction, committed on release unless told otherwise. """
+  def __init__(self, adb: AsyncDB, transaction: bool = False, user_id=None, stickiness: Stickiness|None = None):
+    self.adb = adb
+    self.transaction = transaction
+    self.user_id = user_id # Whoever the request says it is, only used to route reads.
+    self.stickiness = stickiness
+    self.primary = transaction or not adb.db.replicas # Reads go to the primary.
+    self.conn = None # Primary connection
+    self.reader = None # Replica connection
+    self.wrote = False
+    self.released = False
+    self.lock = Lock() # A connection runs one statement at a time, even if the handler gathers queries.
+
+  async def connection(self, write: bool) -> DBConnection:
+    if not (write or self.primary) and self.reader is None and self.user_id is not None and self.stickiness is not None:
+      self.primary = await self.stickiness.is_sticky(self.user_id) # Checked once, on the first read.
+    if write or self.primary:
+      if self.conn is None:
+        self.conn = await self.adb.run(self.adb.db.lease, self.transaction)
+      return self.conn
+    if self.reader is None:
+      self.reader = await self.adb.run(self.adb.db.lease, False, False)
+    return self.reader
+
+  async def run(self, func, *args, write: bool = False):
+    async with self.lock:
+      conn = await self.connection(write)
+      if write:
+        self.wrote = self.primary = True
+      return await self.adb.run(func, conn, *args)
+
+  def _execute(self, conn: DBConnection, stmt: str, args: tuple) -> None:
+    conn.execute(stmt, *args)
+    if not self.transaction:
+      conn.commit(close=False)
+
+  def _executemany(self, conn: DBConnection, stmt: str, rows: Sequence[tuple]) -> None: # All rows in one transaction, same as DB.
+    if self.transaction:
+      return conn.executemany(stmt, rows)
+    conn.begin()
+    try:
+      conn.executemany(stmt, rows)
+    except:
+      conn.rollback(close=False)
+      raise
+    conn.commit(close=False)
+
+  async def query_row(self, query: str, *args) -> dict:
+    if self.released: # Someone kept using it after the response went out (a background task), dont leak a lease.
+      return await self.adb.query_row(query, *args, primary=self.primary)
+    return await self.run(DBConnection.query_row, query, *args)
+
+  async def query(self, query: str, *args) -> list[dict]:
+    if self.released:
+      return await self.adb.query(query, *args, primary=self.primary)
+    return await self.run(DBConnection.query, query, *args)
+
+  async def query_tuples(self, query: str, *args) -> list[tuple]:
+    if self.released:
+      return await self.adb.query_tuples(query, *args, primary=self.primary)
+    return await self.run(DBConnection.query_tuples, query, *args)
+
+  async def execute(self, stmt: str, *args) -> None:
+    if self.released:
+      return await self.adb.execute(stmt, *args)
+    return await self.run(self._execute, stmt, args, write=True)
+
+  async def executemany(self, stmt: str, rows: Sequence[tuple]) -> None:
+    if self.released:
+      return await self.adb.executemany(stmt, rows)
+    return await self.run(self._executemany, stmt, rows, write=True)
+
+  async def begin(self) -> AsyncDBConnection: # Explicit transactions get their own connection, they commit or roll back on their own.
+    self.note_write()
+    return await self.adb.begin()
+
+  def note_write(self) -> None:
+    """ For writes that dont go through us (write behind, transactions), so the user still reads them back. """
+    self.wrote = self.primary = True
+
+  async def release(self, commit: bool = True) -> None:
+    """ Hand the connections back to the pools. In transaction mode this is where the request commits (or rolls back). """
+    async with self.lock:
+      self.released = True
+      conn, self.conn = self.conn, None
+      reader, self.reader = self.reader, None
+      if reader is not None:
+        await self.adb.run(reader.close)
+      if conn is not None:
+        if self.transaction and commit:
+          await self.adb.run(conn.commit)
+        else: # Nothing uncommitted outside transaction mode, this just makes sure the pool gets it back clean.
+          await self.adb.run(conn.rollback)
+    if self.wrote and self.user_id is not None and self.stickiness is not None:
+      await self.stickiness.wrote(self.user_id)
@@ -1,4 +1,7 @@
 from argon2 import PasswordHasher, exceptions
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from utils import tracing
 import secrets, random, string
 
 # So we have an object to work with
@@ -9,26 +12,60 @@ class Password(object):
 
         self.hash = hash
 
+    def salted(self):
+        return f"{self.salt}|{self.plaintext}"
+
     def _hash(self, hasher):
-        self.hash = hasher.hash(f"{self.salt}|{self.plaintext}")
+        self.hash = hasher.hash(self.salted())
 
-    def verify_hash(self, hasher, hash_to_check): 
-        compiled = f"{self.salt}|{self.plaintext}"
-        return hasher.verify(hash_to_check, compiled)
+    def verify_hash(self, hasher, hash_to_check):
+        return hasher.verify(hash_to_check, self.salted())
 
 
-class Hasher:
+class HasherBusy(Exception):
     def __init__(self):
-        self.password_hasher = PasswordHasher() 
+        super().__init__("Too many password hashes waiting.")
+
+
+class Hasher:
+    """ Argon2 runs on its own small thread pool, argon2-cffi drops the GIL while hashing so it never stalls the event loop.
+    Sanic workers are daemon processes and cant start a process pool of their own, threads get the same parallelism here. """
+    def __init__(self, params: dict | None = None, threads: int = 2, max_waiting: int = 64):
+        self.password_hasher = PasswordHasher(**(params or {})) # time_cost, memory_cost, parallelism... from config.json
+        self.threads = threads # How many hashes can run at once.
+        self.max_waiting = max_waiting # How many more can queue up behind them before we start turning logins away.
+        self.pending = 0
+        self.executor = None
 
-    def hash_password(self, password_plaintext):
+    async def run(self, func, *args):
+        if self.pending >= self.threads + self.max_waiting:
+            raise HasherBusy()
+        if self.executor is None: # Created in the worker, not whatever process imported us.
+            self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='argon2')
+        self.pending += 1
+        try:
+            with tracing.span("argon2", op=func.__name__.strip("_"), pending=self.pending): # Includes waiting for a thread.
+                return await get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash_password(self, password_plaintext):
         password = Password(plaintext=password_plaintext)
-        password._hash(self.password_hasher)
+        await self.run(password._hash, self.password_hasher)
         return password
 
-    def verify_password_hash(self, password_plaintext, password_hash, password_salt):
+    def _verify(self, password_hash, salted):
         try:
-            return self.password_hasher.verify(password_hash, f"{password_salt}|{password_plaintext}")
+            return self.password_hasher.verify(password_hash, salted)
         except exceptions.VerifyMismatchError:
             return False
-        
+
+    async def verify_password_hash(self, password_plaintext, password_hash, password_salt):
+        return await self.run(self._verify, password_hash, f"{password_salt}|{password_plaintext}")
+
+    def needs_rehash(self, password_hash): # Cheap, only parses the parameters out of the hash.
+        return self.password_hasher.check_needs_rehash(password_hash)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
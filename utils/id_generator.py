@@ -1,52 +1,156 @@
 import secrets
-from random import randint
-
-def generate_user_id(db_conn):
-    while 1:
-        _id = secrets.randbits(64)
-        check = db_conn.query_row("SELECT id FROM users WHERE id=?", _id)
-        if not check:
-            return _id
-
-def generate_user_discrim(db_conn, username):
-    check = db_conn.query("SELECT discrim FROM users WHERE _name = ?", username)
-    if len(check) == 9999: # The username has hit its limit for discriminators
-        _max = int(f"{str(len(check))}9") # Up the character limit +1
-    elif check != None and len(check) != 0: # There are available discrims
-        _discrims = [int(x) for x in check]
-        _max = max(_discrims)
-    elif check == None or len(check) == 0: # Nobody has used the username before, start out on the minimum for 4 char discrims
-        _max = 9999 # Max combinations for 4 character discriminators
-    while 1:
-        _discrim = randint(1000, _max) # Minimum of 4 char discrims
-        if _discrim == 1000:
-            _discrim = '0001' # Congrats, you got a really rare discrim :)
-        if _discrim not in db_conn.query("SELECT _name FROM users WHERE discrim = ?", _discrim): # username + discrim combo isnt taken
-            return _discrim
-
-def generate_message_id(db_conn):
-    while 1:
-        _id = secrets.randbits(64)
-        check = db_conn.query_row("SELECT id FROM messages WHERE id=?", _id)
-        if not check:
-            return _id
-
-def generate_dm_id(db_conn):
-    while 1:
-        _id = secrets.randbits(64)
-        check = db_conn.query_row("SELECT id FROM DMs WHERE id=?", _id)
-        if not check:
-            return _id
-
-def generate_session_token(redis_conn, author_id):
-    token = redis_conn.get(author_id)
-    if not token:
+from os import environ, getpid
+from re import search
+from threading import Lock
+from time import time_ns
+
+from utils import session_cache
+
+# Snowflake IDs: | 41 bits ms since EPOCH | 5 bits node | 5 bits process | 12 bits sequence |
+# Every worker on every node gets its own node/process pair, so IDs never need checking against the DB, and they sort by creation time.
+EPOCH = 1672531200000 # 2023-01-01 00:00:00 UTC, in ms.
+NODE_BITS = 5
+PROCESS_BITS = 5
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_PROCESS = (1 << PROCESS_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = NODE_BITS + PROCESS_BITS + SEQUENCE_BITS
+
+
+def worker_process_id() -> int: # Sanic names its workers Sanic-Server-<number>-<ident>, fall back on the PID outside of a worker.
+    match = search(r"Server-(\d+)", environ.get("SANIC_WORKER_NAME", ""))
+    return (int(match.group(1)) if match else getpid()) & MAX_PROCESS
+
+
+class Snowflake:
+    def __init__(self, node_id: int = 0, process_id: int | None = None):
+        if not 0 <= node_id <= MAX_NODE:
+            raise ValueError(f"node_id has to be between 0 and {MAX_NODE}.")
+        self.worker_id = (node_id << PROCESS_BITS) | (worker_process_id() if process_id is None else process_id & MAX_PROCESS)
+        self.lock = Lock()
+        self.last = -1
+        self.sequence = 0
+
+    def next(self) -> int:
+        with self.lock:
+            now = time_ns() // 1000000
+            if now < self.last: # The clock went backwards, keep counting on the last timestamp instead of reusing old ones.
+                now = self.last
+            if now == self.last:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0: # Used up this millisecond, wait for the next one.
+                    while now <= self.last:
+                        now = time_ns() // 1000000
+            else:
+                self.sequence = 0
+            self.last = now
+            return ((now - EPOCH) << TIMESTAMP_SHIFT) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+_snowflake = Snowflake()
+
+def configure(node_id: int): # Call once at startup with this node's ID from config.json.
+    global _snowflake
+    _snowflake = Snowflake(node_id)
+
+def generate_user_id():
+    return _snowflake.next()
+
+# Taken discriminators for each username are bits in a Redis bitmap, seeded from the DB the first time the username is used.
+# Bit 0 is never a discriminator, it is set on seeding so an existing key always means a seeded one. The bitmap only grows
+# as far as the highest discriminator handed out, a username with a handful of users costs a couple of bytes, and it
+# expires once nobody has signed up with the name for a while, to be seeded from the DB again next time.
+DISCRIM_MIN = 1
+DISCRIM_MAX = 9999
+DISCRIM_TTL = 86400 # Seconds. Far longer than a signup takes, so a claimed discriminator is in the DB before the bitmap can go.
+
+# Only the first worker to get here seeds the bitmap, anyone racing it has read the same users from the DB.
+_seed_discrims = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SETBIT', KEYS[1], 0, 1)
+    for i = 2, #ARGV do
+        redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Lowest free discriminator, -1 if the bitmap needs seeding and -2 if every one is taken.
+_claim_discrim = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+local discrim = redis.call('BITPOS', KEYS[1], 0)
+if discrim > tonumber(ARGV[1]) then
+    return -2
+end
+redis.call('SETBIT', KEYS[1], discrim, 1)
+return discrim
+"""
+
+# If the bitmap isnt there the discriminator will be picked up from the DB when it is seeded.
+_release_discrim = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('SETBIT', KEYS[1], ARGV[1], 0)
+end
+return 0
+"""
+
+class DiscriminatorsExhausted(Exception):
+    def __init__(self, username):
+        super().__init__(f"Every discriminator for '{username}' is taken.")
+        self.username = username
+
+def format_discrim(discrim) -> str:
+    return str(discrim).zfill(4)
+
+def _discrim_key(username) -> str:
+    return f"discrim_bits:{username}" # Not discrims:, those were the old free sets.
+
+async def _seed_user_discrims(db_conn, redis_conn, username, key):
+    taken = {int(x) for x in await db_conn.query("SELECT discrim FROM users WHERE _name = ?", username)}
+    await redis_conn.eval(_seed_discrims, 1, key, DISCRIM_TTL, *(x for x in taken if DISCRIM_MIN <= x <= DISCRIM_MAX))
+
+async def generate_user_discrim(db_conn, redis_conn, username):
+    key = _discrim_key(username)
+    for _ in range(3):
+        _discrim = await redis_conn.eval(_claim_discrim, 1, key, DISCRIM_MAX, DISCRIM_TTL)
+        if _discrim == -2:
+            raise DiscriminatorsExhausted(username)
+        if _discrim >= DISCRIM_MIN:
+            return format_discrim(_discrim)
+        await _seed_user_discrims(db_conn, redis_conn, username, key)
+    raise DiscriminatorsExhausted(username)
+
+async def release_user_discrim(redis_conn, username, discrim): # Give a discriminator back, when a user is deleted or their insert failed.
+    await redis_conn.eval(_release_discrim, 1, _discrim_key(username), int(discrim))
+
+def generate_message_id():
+    return _snowflake.next()
+
+def generate_dm_id():
+    return _snowflake.next()
+
+async def generate_session_token(redis_conn, author_id): # Reuses the existing token, logging in on one device doesnt log out the others.
+    while True:
         token = secrets.token_urlsafe(32)
-        redis_conn.set(author_id, token)
-    return token
+        if await redis_conn.set(author_id, token, nx=True): # Only if there is none, two logins at once agree on one token.
+            return token
+        existing = await redis_conn.get(author_id)
+        if existing: # Otherwise it was revoked in between, try again.
+            return existing
+
+async def revoke_session_token(redis_conn, author_id): # Logs the user out everywhere, including every worker's session cache.
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.delete(author_id)
+    pipe.publish(session_cache.INVALIDATE_CHANNEL, str(author_id))
+    await pipe.execute()
 
-def get_session_token(redis_conn, author_id):
-    data = redis_conn.get(author_id)
+async def get_session_token(redis_conn, author_id): # redis_conn can also be a session_cache.SessionCache
+    data = await redis_conn.get(author_id)
     if not data:
         return "fake_data_none"
     return data
@@ -0,0 +1,113 @@
+from json import dumps, loads
+from time import time
+
+# Hot tail cache: the newest messages of each thread (DM, DM channel, guild channel) kept in Redis, so every worker sees the same thing.
+# Threads are keyed by the table their messages live in, so "guild" and "channel" share one entry.
+# Each thread has a version that is bumped on every write, a fill from the DB only lands if nothing was written while it was loading.
+
+LRU_KEY = "msgtail:lru" # sorted set of thread keys, scored by last use
+
+# KEYS: list, complete flag, version, lru
+# ARGV: expected version, complete (0/1), now, max threads, messages... (newest first)
+_fill = """
+local current = redis.call('GET', KEYS[3]) or '0'
+if current ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+if #ARGV > 4 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 5))
+end
+if ARGV[2] == '1' then
+    redis.call('SET', KEYS[2], 1)
+end
+redis.call('ZADD', KEYS[4], ARGV[3], KEYS[1])
+local over = redis.call('ZCARD', KEYS[4]) - tonumber(ARGV[4])
+if over > 0 then
+    for _, victim in ipairs(redis.call('ZRANGE', KEYS[4], 0, over - 1)) do
+        redis.call('DEL', victim, victim .. ':complete')
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[4], 0, over - 1)
+end
+return 1
+"""
+
+# KEYS: list, complete flag, version
+# ARGV: capacity, version ttl, message
+# A thread cached as complete but empty has a flag and no list, LPUSHX would skip it and the empty page would stick.
+_push = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+if redis.call('EXISTS', KEYS[1], KEYS[2]) > 0 then
+    redis.call('LPUSH', KEYS[1], ARGV[3])
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+end
+return 1
+"""
+
+table_for_thread_type = {
+    "dmchannel": "DMChannelmessages",
+    "channel": "messages",
+    "guild": "messages",
+    "user": "DMmessages"
+}
+
+
+class MessageCache:
+    def __init__(self, redis_conn, capacity: int = 100, max_threads: int = 10000, version_ttl: int = 3600):
+        self.redis = redis_conn # redis.asyncio client
+        self.capacity = capacity # messages kept per thread
+        self.max_threads = max_threads # threads kept before the least recently used one gets dropped
+        self.version_ttl = version_ttl # versions only need to outlive a fill
+
+    @staticmethod
+    def key(thread_type: str, thread_id: int) -> str:
+        return f"msgtail:{table_for_thread_type[thread_type]}:{thread_id}"
+
+    async def latest(self, thread_type: str, thread_id: int, limit: int) -> list[dict]|None:
+        """ The newest `limit` messages of a thread, newest first, or None if the cache cant answer. """
+        key = self.key(thread_type, thread_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lrange(key, 0, limit - 1)
+        pipe.exists(f"{key}:complete")
+        pipe.zadd(LRU_KEY, {key: time()}, xx=True)
+        cached, complete, _ = await pipe.execute()
+        if len(cached) < limit and not complete: # Not cached, or the thread has more messages than we have.
+            return None
+        return [loads(msg) for msg in cached]
+
+    async def find(self, thread_type: str, thread_id: int, message_id: int) -> dict|None:
+        for msg in await self.redis.lrange(self.key(thread_type, thread_id), 0, -1):
+            msg = loads(msg)
+            if msg["id"] == message_id:
+                return msg
+        return None
+
+    async def version(self, thread_type: str, thread_id: int) -> str:
+        """ Grab this before reading from the DB, and give it to fill. """
+        return await self.redis.get(f"{self.key(thread_type, thread_id)}:version") or '0'
+
+    async def fill(self, thread_type: str, thread_id: int, version: str, messages: list[dict], complete: bool) -> bool:
+        """ Cache the newest messages of a thread (newest first), complete means the thread has no older messages. """
+        key = self.key(thread_type, thread_id)
+        messages = [dumps(msg, default=float) for msg in messages[:self.capacity]] # default: DECIMAL columns
+        return bool(await self.redis.eval(_fill, 4, key, f"{key}:complete", f"{key}:version", LRU_KEY,
+            version, int(complete), time(), self.max_threads, *messages))
+
+    def _bump(self, pipe, key: str) -> None:
+        pipe.incr(f"{key}:version")
+        pipe.expire(f"{key}:version", self.version_ttl)
+
+    async def push(self, thread_type: str, thread_id: int, message: dict) -> None:
+        """ Write through a new message, only threads that are already cached get it. """
+        key = self.key(thread_type, thread_id)
+        await self.redis.eval(_push, 3, key, f"{key}:complete", f"{key}:version",
+            self.capacity, self.version_ttl, dumps(message, default=float))
+
+    async def invalidate(self, thread_type: str, thread_id: int) -> None:
+        key = self.key(thread_type, thread_id)
+        pipe = self.redis.pipeline(transaction=True)
+        self._bump(pipe, key)
+        pipe.delete(key, f"{key}:complete")
+        pipe.zrem(LRU_KEY, key)
+        await pipe.execute()
@@ -0,0 +1,128 @@
+from bisect import bisect_left
+from math import inf
+
+# Tiny Prometheus text exporter, no client library needed. Everything here runs per request or per event,
+# so recording is a dict lookup and a couple of additions, all the formatting happens when /metrics is scraped.
+# Metrics are per worker process, every worker answers /metrics with its own numbers.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict() # label values -> count
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Gauge:
+    """ Read when scraped, from a function returning {label values: value} (or a bare number without labels). """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = labels
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class ReadCounter(Gauge):
+    """ A counter kept by someone else (pool stats, cache hits), read when scraped like a gauge. Only ever goes up, until a restart. """
+    kind = "counter"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = dict() # label values -> [per bucket counts (last one is +Inf), sum]
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (inf,), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound is inf else f'le="{float(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = dict() # name -> metric
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already exists.")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, read, labels: tuple = ()) -> Gauge:
+        return self.add(Gauge(name, help, read, labels))
+
+    def read_counter(self, name: str, help: str, read, labels: tuple = ()) -> ReadCounter:
+        return self.add(ReadCounter(name, help, read, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e: # A broken gauge shouldnt take the rest with it.
+                print(f"Error reading metric {metric.name}\n{e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry() # What /metrics serves.
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+read_counter = REGISTRY.read_counter
+histogram = REGISTRY.histogram
@@ -0,0 +1,200 @@
+from collections import deque
+from threading import Condition
+from time import monotonic
+
+from utils import metrics
+
+# Our own connection pool, mariadb.ConnectionPool raises the moment it runs dry and has no way to wait for a connection.
+# Connections are opened on demand, so creating a pool (and importing api.py) doesnt need the DB to be up.
+# Callers block for up to `timeout` seconds when every connection is busy, with at most `max_waiting` of them in line.
+# `overflow` extra connections can be opened for bursts, they are closed again as soon as nobody is waiting for them.
+# Checkouts and the DB calls themselves happen on the AsyncDB executor threads, so this is all plain threading.
+
+WAIT_SECONDS = metrics.histogram("db_pool_wait_seconds", "Time to check a connection out of a DB pool.", ("pool",))
+
+
+class PoolTimeout(Exception):
+    def __init__(self, name: str, reason: str):
+        super().__init__(f"No DB connection from {name}: {reason}.")
+
+
+class PooledConnection:
+    """ Proxy for a checked out connection, close() hands it back to the pool instead of closing it. """
+    __slots__ = ("pool", "raw")
+
+    def __init__(self, pool: 'Pool', raw) -> None:
+        self.pool = pool
+        self.raw = raw
+
+    def cursor(self, *args, **kwargs):
+        return self.raw.cursor(*args, **kwargs)
+
+    def begin(self) -> None:
+        self.raw.begin()
+
+    def commit(self) -> None:
+        self.raw.commit()
+
+    def rollback(self) -> None:
+        self.raw.rollback()
+
+    def close(self) -> None:
+        if self.raw is not None:
+            raw, self.raw = self.raw, None
+            self.pool.release(raw)
+
+
+class Pool:
+    def __init__(self, connect, size: int = 20, overflow: int = 0, max_waiting: int = 64, timeout: float = 5.0, ping_interval: float = 30.0, name: str = "pool"):
+        self.connect = connect # Opens a new raw connection, mariadb.connect with everything filled in.
+        self.size = size
+        self.overflow = overflow
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.ping_interval = ping_interval # Connections idle for longer get pinged before anyone gets them.
+        self.name = name
+        self.cond = Condition()
+        self.idle = deque() # (raw connection, idle since), most recently used on the right
+        self.open = 0 # In use or idle
+        self.in_use = 0
+        self.waiting = 0
+        self.closed = False
+        self.checkouts = 0
+        self.waited = 0 # Checkouts that had to wait for a connection
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.rejected = 0 # Turned away because the line was full
+        self.evicted = 0 # Dead connections thrown out
+
+    @property
+    def max_size(self) -> int:
+        return self.size + self.overflow
+
+    def get_connection(self) -> PooledConnection:
+        start = monotonic()
+        waited = False
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise PoolTimeout(self.name, "pool is closed")
+                if self.idle:
+                    raw, since = self.idle.pop() # Newest first, so the extra ones sit idle and get closed.
+                    break
+                if self.open < self.max_size:
+                    raw, since = None, None
+                    self.open += 1
+                    break
+                if not waited and self.waiting >= self.max_waiting:
+                    self.rejected += 1
+                    raise PoolTimeout(self.name, "too many waiting")
+                remaining = start + self.timeout - monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(self.name, f"timed out after {self.timeout}s")
+                waited = True
+                self.waiting += 1
+                try:
+                    self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_use += 1
+        try:
+            if raw is not None and monotonic() - since > self.ping_interval and not self.alive(raw):
+                self.evict(raw)
+                raw = None
+            if raw is None:
+                raw = self.connect()
+        except:
+            with self.cond:
+                self.in_use -= 1
+                self.open -= 1
+                self.cond.notify()
+            raise
+        wait = monotonic() - start
+        with self.cond:
+            self.checkouts += 1
+            if waited:
+                self.waited += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            WAIT_SECONDS.observe(wait, self.name)
+        return PooledConnection(self, raw)
+
+    def release(self, raw) -> None:
+        with self.cond:
+            self.in_use -= 1
+            if self.closed or (self.open > self.size and not self.waiting): # Burst is over, dont keep the extra ones.
+                self.open -= 1
+                close = True
+            else:
+                self.idle.append((raw, monotonic()))
+                close = False
+            self.cond.notify()
+        if close:
+            self.close_raw(raw)
+
+    @staticmethod
+    def alive(raw) -> bool:
+        try:
+            raw.ping()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def close_raw(raw) -> None:
+        try:
+            raw.close()
+        except Exception: # Already dead.
+            pass
+
+    def evict(self, raw) -> None: # raw is already out of idle and still counted in open.
+        self.close_raw(raw)
+        with self.cond:
+            self.evicted += 1
+
+    def check(self) -> None:
+        """ Ping every connection that has been idle for a while and throw out the dead ones. Blocks, run it on the executor. """
+        now = monotonic()
+        with self.cond:
+            stale = [entry for entry in self.idle if now - entry[1] > self.ping_interval]
+            for entry in stale:
+                self.idle.remove(entry)
+                self.in_use += 1 # Not idle and not free while we ping it.
+        for raw, _ in stale:
+            if self.alive(raw):
+                self.release(raw)
+            else:
+                self.evict(raw)
+                with self.cond:
+                    self.in_use -= 1
+                    self.open -= 1
+                    self.cond.notify()
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+            self.open -= len(idle)
+            self.cond.notify_all()
+        for raw, _ in idle:
+            self.close_raw(raw)
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "size": self.size,
+                "overflow": self.overflow,
+                "open": self.open,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "waited": self.waited,
+                "wait_seconds_total": self.wait_total,
+                "wait_seconds_max": self.wait_max,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "evicted": self.evicted
+            }
@@ -0,0 +1,66 @@
+import sys
+from asyncio import tasks
+from collections import Counter
+from os import sep
+from threading import Lock, current_thread, enumerate as threads
+from time import monotonic, sleep
+
+# On demand sampling profiler. A thread wakes up every `interval` seconds, grabs the stack the event loop thread
+# (or every thread) is running right now and counts it. Nothing is installed while no profile is running.
+# Output is collapsed stacks ("root;caller;callee count" per line), what flamegraph.pl and speedscope read.
+
+_running = Lock() # One profile per worker at a time, they would only skew each other.
+
+
+class ProfilerBusy(Exception):
+    def __init__(self):
+        super().__init__("A profile is already running on this worker.")
+
+
+def _frame_name(code) -> str:
+    path = code.co_filename.rsplit(sep, 2)
+    return f"{code.co_name} ({sep.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> list[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def sample(loop, loop_thread: int, seconds: float, interval: float = 0.005, all_threads: bool = False) -> tuple[Counter, int]:
+    """ Blocks for `seconds`, run it on its own thread. Returns (collapsed stack -> samples, samples taken). """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = current_thread().ident
+        names = {thread.ident: thread.name for thread in threads()}
+        stacks = Counter()
+        taken = 0
+        end = monotonic() + seconds
+        while monotonic() < end:
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == me or (not all_threads and ident != loop_thread):
+                    continue
+                if ident == loop_thread:
+                    task = tasks._current_tasks.get(loop) # Which task the loop is stepping, read racily, fine for sampling.
+                    root = f"task:{task.get_name()}" if task is not None else "loop"
+                else:
+                    if ident not in names:
+                        names = {thread.ident: thread.name for thread in threads()}
+                    root = f"thread:{names.get(ident, ident)}"
+                stacks[";".join([root] + _stack(frame))] += 1
+            del frames
+            taken += 1
+            sleep(interval)
+        return stacks, taken
+    finally:
+        _running.release()
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,102 @@
+from collections import deque
+from contextvars import ContextVar
+from re import compile
+from threading import Lock
+
+# Where DB time goes: every statement is timed and aggregated by fingerprint (the SQL with literals and whitespace
+# normalized), slow ones are logged with the route that ran them, and a request running the same statement over and
+# over (N+1) gets reported when it finishes. Statements run on the AsyncDB executor threads, AsyncDB.run copies the
+# request's context over so these context vars are still set there.
+
+route = ContextVar("query_route", default=None) # Route pattern of the request we are running for.
+request_counts = ContextVar("query_request_counts", default=None) # fingerprint -> times run, for the current request.
+
+_strings = compile(r"'(?:[^'\\]|\\.)*'")
+_numbers = compile(r"\b\d+(?:\.\d+)?\b")
+_lists = compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_whitespace = compile(r"\s+")
+
+def fingerprint(sql: str) -> str:
+    sql = _strings.sub("?", sql)
+    sql = _numbers.sub("?", sql)
+    sql = _whitespace.sub(" ", sql).strip()
+    return _lists.sub("(?+)", sql) # IN (?,?,?) and IN (?,?) are the same statement.
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+
+class QueryStats:
+    def __init__(self, slow_seconds: float = 0.1, samples: int = 512, n_plus_one: int = 5, slow_kept: int = 100):
+        self.slow_seconds = slow_seconds # Anything slower goes to the slow query log.
+        self.samples = samples # Recent timings kept per fingerprint for the percentiles.
+        self.n_plus_one = n_plus_one # Same statement this many times in one request gets reported.
+        self.lock = Lock()
+        self.fingerprints = dict() # fingerprint -> [count, total seconds, recent timings]
+        self.slow = deque(maxlen=slow_kept) # (route, seconds, fingerprint), newest on the right
+        self.repeated = dict() # (route, fingerprint) -> requests that ran it n_plus_one times or more
+
+    def record(self, fingerprint: str, seconds: float) -> None:
+        with self.lock:
+            entry = self.fingerprints.get(fingerprint)
+            if entry is None:
+                entry = self.fingerprints[fingerprint] = [0, 0.0, deque(maxlen=self.samples)]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2].append(seconds)
+        counts = request_counts.get()
+        if counts is not None:
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+        if seconds >= self.slow_seconds:
+            where = route.get() or "background"
+            with self.lock: # report() copies it from another thread.
+                self.slow.append((where, seconds, fingerprint))
+            print(f"Slow query ({seconds * 1000:.1f}ms) from {where}: {fingerprint}")
+
+    def begin_request(self, route_name: str) -> None:
+        route.set(route_name)
+        request_counts.set(dict())
+
+    def end_request(self) -> list[tuple[str, int]]:
+        """ Statements the request ran n_plus_one times or more, as (fingerprint, times). """
+        counts = request_counts.get()
+        request_counts.set(None)
+        if not counts:
+            return []
+        repeated = [(fp, times) for fp, times in counts.items() if times >= self.n_plus_one]
+        if repeated:
+            where = route.get() or "background"
+            with self.lock:
+                for fp, times in repeated:
+                    self.repeated[(where, fp)] = self.repeated.get((where, fp), 0) + 1
+            for fp, times in repeated:
+                print(f"Possible N+1 in {where}: ran {times} times: {fp}")
+        return repeated
+
+    def snapshot(self) -> list[dict]:
+        """ Every fingerprint, most total time first. """
+        with self.lock:
+            entries = [(fp, count, total, sorted(recent)) for fp, (count, total, recent) in self.fingerprints.items()]
+        entries.sort(key=lambda entry: entry[2], reverse=True)
+        return [{
+            "fingerprint": fp,
+            "count": count,
+            "total_seconds": total,
+            "p50_seconds": _percentile(recent, 0.5),
+            "p99_seconds": _percentile(recent, 0.99)
+        } for fp, count, total, recent in entries]
+
+    def report(self) -> dict:
+        """ Everything we know, for the admin queries route: timings by fingerprint, the slow query log (newest first) and possible N+1s. """
+        with self.lock:
+            slow = list(self.slow)
+            repeated = sorted(self.repeated.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "statements": self.snapshot(),
+            "slow": [{"route": where, "seconds": seconds, "fingerprint": fp} for where, seconds, fp in reversed(slow)],
+            "repeated": [{"route": where, "fingerprint": fp, "requests": requests} for (where, fp), requests in repeated]
+        }
+
+
+STATS = QueryStats()
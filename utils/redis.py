@@ -1,6 +1,44 @@
-import redis
+from time import perf_counter
 
-RDB = redis.Redis(
+import redis.asyncio
+from redis.asyncio.client import Pipeline
+
+from utils import metrics, tracing
+
+REDIS_SECONDS = metrics.histogram("redis_command_seconds", "Redis round trips, pipelines count as one.", ("command",))
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = perf_counter()
+        try:
+            with tracing.span("redis PIPELINE", "CLIENT", commands=len(self.command_stack)):
+                return await super().execute(raise_on_error)
+        finally:
+            REDIS_SECONDS.observe(perf_counter() - start, "PIPELINE")
+
+
+class InstrumentedRedis(redis.asyncio.Redis):
+    """ Times every command, pub/sub reads dont go through here so idle subscribers dont skew it. """
+    async def execute_command(self, *args, **options):
+        start = perf_counter()
+        try:
+            with tracing.span(f"redis {args[0]}", "CLIENT"):
+                return await super().execute_command(*args, **options)
+        finally:
+            REDIS_SECONDS.observe(perf_counter() - start, args[0])
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# One async client for everything, backed by a bounded pool so a burst waits for a connection instead of opening hundreds.
+# Pub/sub subscribers (event broker, session cache) each keep one of these connections for themselves.
+POOL = redis.asyncio.BlockingConnectionPool(
   host='127.0.0.1',
   port=6379,
-  decode_responses=True)
\ No newline at end of file
+  decode_responses=True,
+  max_connections=64,
+  timeout=5)
+
+ARDB = InstrumentedRedis(connection_pool=POOL)
@@ -0,0 +1,148 @@
+from asyncio import create_task
+from collections import deque
+from itertools import count
+from sys import getsizeof
+
+# Who is connected to this worker. A user can have any number of connections (devices, tabs), each one gets its own ID.
+# Users are spread over a fixed number of shards so no single dict has to hold (and rehash) every online user.
+# Every connection has its own bounded outbound queue and writer, so one slow socket never holds up anybody else.
+
+RESYNC_FRAME = 'event: resync\ndata: {}' # Sent instead of what we threw away, the client should refetch.
+
+
+class OutboundPolicy:
+    """ What every connection does when its outbound queue is full, shared by all of them. """
+    policies = ("drop", "coalesce", "disconnect")
+
+    def __init__(self, queue_size: int = 256, on_full: str = "disconnect") -> None:
+        if on_full not in self.policies:
+            raise ValueError(f"Slow consumer policy has to be one of {', '.join(self.policies)}.")
+        self.queue_size = queue_size
+        self.on_full = on_full # drop: lose the new frame, coalesce: replace the whole backlog with one resync, disconnect: close the socket.
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+
+class Connection:
+    __slots__ = ("id", "user_id", "ws", "policy", "pending", "writer", "closed") # Thousands of these sit idle, keep them small.
+
+    def __init__(self, conn_id: int, user_id: int, ws, policy: OutboundPolicy) -> None:
+        self.id = conn_id
+        self.user_id = user_id
+        self.ws = ws
+        self.policy = policy
+        self.pending = None # deque of frames, only while there is something to send.
+        self.writer = None # Task draining pending, only while there is something to send.
+        self.closed = False
+
+    def enqueue(self, frame) -> bool:
+        """ Queue a frame without waiting on the socket. Returns False if it was thrown away. """
+        if self.closed:
+            return False
+        if self.pending is None:
+            self.pending = deque()
+        elif len(self.pending) >= self.policy.queue_size:
+            match self.policy.on_full:
+                case "drop":
+                    self.policy.dropped += 1
+                    return False
+                case "coalesce":
+                    self.policy.coalesced += 1
+                    self.pending.clear()
+                    self.pending.append(RESYNC_FRAME)
+                case "disconnect":
+                    self.policy.disconnected += 1
+                    self.close()
+                    return False
+        self.pending.append(frame)
+        if self.writer is None:
+            self.writer = create_task(self.drain())
+        return True
+
+    async def drain(self) -> None:
+        try:
+            while self.pending:
+                await self.ws.send(self.pending.popleft())
+        except Exception: # The socket is gone, the handler unregisters us when its recv fails too.
+            self.closed = True
+        finally:
+            self.writer = None
+            self.pending = None
+
+    def close(self) -> None:
+        self.closed = True
+        self.pending = None
+        create_task(self.ws.close())
+
+    def __repr__(self) -> str:
+        return f"Connection({self.id}, user={self.user_id})"
+
+
+class ConnectionRegistry:
+    def __init__(self, shards: int = 64, policy: OutboundPolicy | None = None) -> None:
+        self.policy = policy or OutboundPolicy()
+        self.shards = [dict() for _ in range(shards)] # user ID -> {connection ID -> Connection}
+        self.ids = count(1)
+        self.users = 0
+        self.connections = 0
+
+    def shard(self, user_id: int) -> dict:
+        return self.shards[hash(user_id) % len(self.shards)]
+
+    def add(self, user_id: int, ws) -> tuple[Connection, bool]:
+        """ Registers a connection, also returns whether it is the user's first one. """
+        conn = Connection(next(self.ids), user_id, ws, self.policy)
+        sessions = self.shard(user_id).setdefault(user_id, dict())
+        sessions[conn.id] = conn
+        self.connections += 1
+        if len(sessions) == 1:
+            self.users += 1
+            return conn, True
+        return conn, False
+
+    def remove(self, conn: Connection) -> bool:
+        """ Unregisters a connection, returns whether that was the user's last one. Removing twice is harmless. """
+        shard = self.shard(conn.user_id)
+        sessions = shard.get(conn.user_id)
+        if sessions is None or sessions.pop(conn.id, None) is None:
+            return False
+        self.connections -= 1
+        if sessions:
+            return False
+        del shard[conn.user_id]
+        self.users -= 1
+        return True
+
+    def get(self, user_id: int):
+        """ Every live connection of a user. """
+        sessions = self.shard(user_id).get(user_id)
+        return sessions.values() if sessions else ()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.shard(user_id)
+
+    def __len__(self) -> int: # Online users, not connections.
+        return self.users
+
+    def __iter__(self): # Online user IDs.
+        for shard in self.shards:
+            yield from shard
+
+    def stats(self) -> dict:
+        """ Walks everything, dont call this per event. """
+        shards = getsizeof(self.shards) + sum(getsizeof(shard) for shard in self.shards)
+        sessions_size = 0
+        for shard in self.shards:
+            for sessions in shard.values():
+                sessions_size += getsizeof(sessions) + sum(getsizeof(conn) for conn in sessions.values())
+        return { # Registry overhead only, the websockets themselves are not counted.
+            "users": self.users,
+            "connections": self.connections,
+            "bytes": shards + sessions_size,
+            "bytes_per_connection": sessions_size / self.connections if self.connections else 0.0,
+            "queued": sum(len(conn.pending) for shard in self.shards for sessions in shard.values() for conn in sessions.values() if conn.pending),
+            "dropped": self.policy.dropped,
+            "coalesced": self.policy.coalesced,
+            "disconnected": self.policy.disconnected
+        }
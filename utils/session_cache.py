@@ -0,0 +1,88 @@
+from asyncio import CancelledError, create_task, sleep
+from collections import OrderedDict
+from time import monotonic
+
+# Per worker cache of session tokens in front of Redis, so most auth checks never leave the process.
+# Anything that rotates or revokes a token publishes the user ID on INVALIDATE_CHANNEL and every worker drops it.
+# The TTL is the safety net for invalidations that get lost while the subscriber reconnects.
+
+INVALIDATE_CHANNEL = "session_invalidate"
+
+
+async def publish_invalidation(redis_conn, author_id) -> None:
+    await redis_conn.publish(INVALIDATE_CHANNEL, str(author_id))
+
+
+class SessionCache:
+    def __init__(self, redis_conn, maxsize: int = 50000, ttl: float = 60):
+        self.redis = redis_conn # redis.asyncio client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tokens = OrderedDict() # author ID -> (expires at, token), least recently used first
+        self.generation = 0 # Bumped on every invalidation so a Redis read that raced one doesnt get cached.
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.subscriber = None
+
+    async def get(self, author_id): # Same as redis_conn.get, so it can be handed to id_generator.get_session_token.
+        key = str(author_id)
+        entry = self.tokens.get(key)
+        if entry is not None and monotonic() < entry[0]:
+            self.tokens.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        generation = self.generation
+        token = await self.redis.get(key)
+        if token and generation == self.generation: # Only cache real tokens, missing ones are what an attacker would be hammering.
+            self.tokens[key] = (monotonic() + self.ttl, token)
+            self.tokens.move_to_end(key)
+            while len(self.tokens) > self.maxsize:
+                self.tokens.popitem(last=False)
+        return token
+
+    def invalidate(self, author_id=None) -> None: # No ID drops everything.
+        self.generation += 1
+        self.invalidations += 1
+        if author_id is None:
+            self.tokens.clear()
+        else:
+            self.tokens.pop(str(author_id), None)
+
+    async def listen(self) -> None:
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            while True:
+                try:
+                    await pubsub.subscribe(INVALIDATE_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.invalidate(message["data"])
+                except CancelledError:
+                    raise
+                except Exception as e: # Lost Redis, the client reconnects on the next read.
+                    print(f"Session cache subscriber error, dropping cached tokens\n{e}")
+                    self.invalidate() # We might have missed invalidations.
+                    await sleep(1)
+        finally:
+            await pubsub.close()
+
+    def start(self) -> None:
+        self.subscriber = create_task(self.listen())
+
+    def stop(self) -> None:
+        if self.subscriber is not None:
+            self.subscriber.cancel()
+            self.subscriber = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.tokens),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
@@ -1,72 +1,162 @@
-from asyncio import Queue, Lock, gather, QueueEmpty, sleep
-from json import dumps
+from asyncio import Queue, Lock, gather, QueueEmpty, current_task, ensure_future, shield, sleep
+from collections import OrderedDict
+from time import monotonic, time
+from json import dumps as _std_dumps
+
+try: # orjson is optional, it is a lot faster at encoding event data.
+	from orjson import dumps as _orjson_dumps
+
+	def dumps(obj) -> str:
+		try:
+			return _orjson_dumps(obj).decode()
+		except TypeError: # Something orjson wont encode (ints over 64 bits, non str keys), let the stdlib deal with it.
+			return _std_dumps(obj)
+except ImportError:
+	dumps = _std_dumps
 
 from models.events import Event
-from utils.db import DB
+from utils import metrics, tracing
+from utils.db import AsyncDB
+from utils.registry import Connection, ConnectionRegistry, OutboundPolicy
+
+FANOUT = metrics.histogram("sse_fanout_connections", "Local connections each event was queued for.", buckets=metrics.SIZE_BUCKETS)
 
 
 class SSE: # TODO: rename to event handler
-	def __init__(self, queue: Queue, db: DB) -> None:
-		self.conns = dict()
+	member_queries = { # Where to find who belongs to a destination.
+		"guild": "SELECT user_id FROM guildusers WHERE parent_id = ?",
+		"dmchannel": "SELECT user_id FROM dmchannelusers WHERE parent_id = ?"
+	}
+
+	def __init__(self, queue: Queue, db: AsyncDB, members_max: int = 10000, members_ttl: float = 60, outbound: OutboundPolicy | None = None, max_batch: int = 64) -> None:
+		self.conns = ConnectionRegistry(policy=outbound) # user ID -> every connection they have on this worker
+		self.max_batch = max(1, min(max_batch, self.conns.policy.queue_size // 4)) # Well under a connection's queue, so a burst alone never fills it.
 		self.lock = Lock()
 		self.queue = queue
 		self.db = db
+		self.members = OrderedDict() # (destination_type, destination) -> (loaded at, frozenset of user IDs), oldest used first.
+		self.members_max = members_max
+		self.members_ttl = members_ttl # Safety net for membership changes we never get told about (other workers, manual edits).
+		self.members_generation = 0 # Bumped on every invalidation so a load that raced one doesnt get cached.
+		self.members_loading = dict() # key -> future of a load that is in progress
+		self.broker = None # utils.broker.EventBroker, when set events go through Redis so every worker sees them.
+
+	async def get_members(self, destination: int, destination_type: str) -> frozenset:
+		""" Everyone who belongs to a destination, loaded from the DB the first time and cached until invalidated. """
+		if destination_type == "user": # A user destination only ever has the one member.
+			return frozenset((destination,))
+		if destination_type not in self.member_queries:
+			raise Exception("Something went wrong matching the correct destination.")
+		key = (destination_type, destination)
+		cached = self.members.get(key)
+		if cached is not None and monotonic() - cached[0] < self.members_ttl:
+			self.members.move_to_end(key)
+			return cached[1]
+		loading = self.members_loading.get(key)
+		if loading is None: # Events for the same destination that come in while it loads share the one query.
+			loading = self.members_loading[key] = ensure_future(self.load_members(key))
+		return await shield(loading)
+
+	async def load_members(self, key: tuple) -> frozenset:
+		generation = self.members_generation
+		try:
+			members = frozenset(await self.db.query(self.member_queries[key[0]], key[1]))
+		finally:
+			del self.members_loading[key]
+		if generation == self.members_generation: # Nothing was invalidated while we were waiting on the DB.
+			self.members[key] = (monotonic(), members)
+			while len(self.members) > self.members_max:
+				self.members.popitem(last=False)
+		return members
 
-	def get_correct_connections(self, destination, destination_type, sending_conn_ref):
+	def invalidate_members(self, destination_type: str | None = None, destination: int | None = None) -> None:
+		""" Call this whenever someone joins or leaves a destination. No arguments drops the whole index. """
+		self.members_generation += 1
+		if destination_type is None:
+			self.members.clear()
+		else:
+			self.members.pop((destination_type, int(destination)), None)
+
+	def invalidate_member(self, user_id: int) -> None:
+		""" Drops every cached destination a user is in, for when the user themselves goes away. """
+		self.members_generation += 1
+		for key in [key for key, (_, members) in self.members.items() if user_id in members]:
+			del self.members[key]
+
+	async def get_correct_connections(self, destination, destination_type, sending_conn_ref):
 		""" This gets the correct connections to send the event to, that way we arent sending events to people who should not be getting them, for example: someone receiving a message for a server they arent in at all. """
-		match destination_type: # Since the destination is where the event is happening, we can just grab all users from the destination.
-			case "guild":
-				connections = self.db.query("SELECT user_id FROM guildusers WHERE parent_id = ?", destination)
-			case "dmchannel":
-				connections = self.db.query("SELECT user_id FROM dmchannelusers WHERE parent_id = ?", destination)
-			case "user":
-				connections = self.db.query("SELECT id FROM users WHERE id = ?", destination)
-			case _:
-				raise Exception("Something went wrong matching the correct destination.")
-		print(f"Destination: {destination}")
-		print(f"Possible destination connections: {connections}")
-		to_return = []
-		for reference in connections:
-			if reference in self.conns and not reference == sending_conn_ref:
-				to_return.append(self.conns[reference])
-		print(f"Online Connections: {to_return}")
-		return to_return
+		members = await self.get_members(int(destination), destination_type) # Since the destination is where the event is happening, we can just grab all users from the destination.
+		if len(self.conns) < len(members): # Walk whichever side is smaller, big guilds usually only have a few people online.
+			online = [reference for reference in self.conns if reference in members]
+		else:
+			online = [reference for reference in members if reference in self.conns]
+		return [conn for reference in online if not reference == sending_conn_ref for conn in self.conns.get(reference)] # Every device they have connected.
 
 	def format(self, event: Event):
-		return f'event: {event.event}\ndata: {dumps(event.data)}'
+		if event.frame is None: # Only encode once, no matter how many connections get it.
+			event.frame = f'event: {event.event}\ndata: {dumps(event.data)}'
+		return event.frame
 		#return bytes(f"event: {event.event}\ndata: {event.data}\n\n", encoding='utf8')
 
-	# TODO: Support for multiple connections per client.
-	async def register(self, connection_reference, connection): # this is for registering clients 
-		#await self.lock.acquire() # we cant insert while the push loop is running, or while there are are currently people in queue to register
-		self.conns[connection_reference] = connection
-		#await self.lock.release()
+	async def register(self, connection_reference, connection) -> Connection: # this is for registering clients, keep what it returns for unregistering.
+		conn, first = self.conns.add(connection_reference, connection)
+		if first and self.broker is not None: # Start getting events for everything they are in from every worker.
+			await self.broker.user_online(connection_reference)
+		return conn
 
-	# TODO: Support for multiple connections per client.
-	async def unregister(self, connection_reference): # this is for unregistering clients
-		#await self.lock.acquire() # we cant remove while the push loop is running, or while there are are currently people in queue to register/unregister
-		del self.conns[connection_reference] # BUG?: erroring? im not removing it anywhere else, watch for if this errors after changing to del
-		#await self.lock.release()
+	async def unregister(self, conn: Connection): # this is for unregistering clients
+		last = self.conns.remove(conn)
+		if last and self.broker is not None:
+			await self.broker.user_offline(conn.user_id)
 
 	async def register_event(self, event: Event): # this is for internally putting an event into the queue 
-		await self.queue.put(event)
+		event.queued_at = time()
+		with tracing.span("sse.register_event", "PRODUCER", event=event.event, destination=f"{event.destination_type}:{event.destination}") as span:
+			if span is not None: # The fanout, wherever it happens, joins this trace.
+				event.trace = (span.trace_id, span.id)
+			if self.broker is not None:
+				try:
+					return await self.broker.publish(event) # Comes back to us (and every other worker that needs it) through the broker.
+				except Exception as e:
+					print(f"Error publishing event, only delivering it locally\n{e}")
+			await self.queue.put(event)
 
 	async def get_event(self): # this is for internally getting an event from the queue 
 		try:
-			await self.queue.get_nowait()
+			return self.queue.get_nowait()
 		except QueueEmpty:
 			return None
 
+	def drain(self, first: Event) -> list[Event]: # Grab what is already queued, without waiting, so a burst gets handled in a few wakeups.
+		batch = [first]
+		while len(batch) < self.max_batch:
+			try:
+				batch.append(self.queue.get_nowait())
+			except QueueEmpty:
+				break
+		return batch
+
+	async def push_batch(self, batch: list[Event]) -> None:
+		targets = await gather(*[self.get_correct_connections(data.destination, data.destination_type, data.conn_ref) for data in batch], return_exceptions=True)
+		for data, conns in zip(batch, targets): # In queue order, every connection's own queue keeps it that way.
+			if isinstance(conns, Exception):
+				print(f"Error getting connections for event {data.event}\n{conns}")
+				continue
+			fanout = None
+			if data.trace is not None:
+				fanout = tracing.TRACER.continue_trace(*data.trace, "sse.fanout", "CONSUMER", connections=len(conns),
+					delivery_delay_ms=round((time() - data.queued_at) * 1000, 3) if data.queued_at else None)
+			frame = self.format(data)
+			for conn in conns:
+				conn.enqueue(frame) # Never waits on the socket, its writer takes it from here.
+			FANOUT.observe(len(conns))
+			if fanout is not None:
+				fanout.finish()
+
 	async def event_push_loop(self):
 		print("Starting SSE task.")
+		current_task().set_name("event_push_loop") # So it can be told apart in profiles, Sanic only names tasks added after startup.
 		while True:
-			try:
-				data = self.queue.get_nowait() # Get new event if there is one.
-			except QueueEmpty:
-				pass
-			else:
-				coros = [conn.send(self.format(data)) for conn in self.get_correct_connections(data.destination, data.destination_type, data.conn_ref)] 
-				await gather(*coros) # Send to all connections.
-				print(f"Sent data to {len(coros)} connections.")
-			finally:
-				await sleep(0)
+			batch = self.drain(await self.queue.get()) # Sleep until there is an event, then take the rest of the burst with it.
+			await self.push_batch(batch)
+			await sleep(0) # Let the connection writers send this batch before the next one is queued on top of it.
@@ -0,0 +1,153 @@
+import os
+from collections import deque
+from contextvars import ContextVar
+from json import dumps
+from random import getrandbits, random
+from time import time
+
+# Lightweight request tracing. A sampled request gets a trace ID in setup_connection, and DB statements, Redis calls,
+# password hashing and event hand-offs made while handling it become child spans. Events carry their trace with them
+# (through the broker too), so the fanout on whichever worker delivers them shows up in the same trace.
+# Spans are written as Zipkin v2 JSON, one per line, or kept in memory. Unsampled requests never create a span,
+# every helper here is a context var lookup and nothing else for them.
+
+SERVICE = {"serviceName": "razdor-api"}
+
+current = ContextVar("trace_span", default=None)
+
+
+def _id() -> str:
+    return f"{getrandbits(64):016x}"
+
+
+class Span:
+    __slots__ = ("trace_id", "id", "parent_id", "name", "kind", "start", "duration", "tags")
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, kind: str | None = None, tags: dict | None = None) -> None:
+        self.trace_id = trace_id
+        self.id = _id()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind # SERVER, CLIENT, PRODUCER, CONSUMER or None
+        self.start = time()
+        self.duration = None
+        self.tags = tags or {}
+
+    def tag(self, key: str, value) -> None:
+        self.tags[key] = str(value)
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.duration = time() - self.start
+        if error is not None:
+            self.tags["error"] = str(error) or type(error).__name__
+        TRACER.export(self)
+
+    def zipkin(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "id": self.id,
+            "name": self.name,
+            "timestamp": int(self.start * 1_000_000),
+            "duration": max(int(self.duration * 1_000_000), 1),
+            "localEndpoint": SERVICE,
+            "tags": {key: str(value) for key, value in self.tags.items()}
+        }
+        if self.parent_id is not None:
+            span["parentId"] = self.parent_id
+        if self.kind is not None:
+            span["kind"] = self.kind
+        return span
+
+
+class span:
+    """ Child of whatever span is current, as a (async) context manager. Does nothing outside a sampled trace. """
+    __slots__ = ("name", "kind", "tags", "span", "token")
+
+    def __init__(self, name: str, kind: str | None = None, **tags) -> None:
+        self.name = name
+        self.kind = kind
+        self.tags = tags
+
+    def __enter__(self) -> Span | None:
+        parent = current.get()
+        if parent is None:
+            self.span = None
+            return None
+        self.span = Span(parent.trace_id, parent.id, self.name, self.kind, self.tags)
+        self.token = current.set(self.span)
+        return self.span
+
+    def __exit__(self, kind, error, traceback) -> None:
+        if self.span is not None:
+            current.reset(self.token)
+            self.span.finish(error)
+
+    async def __aenter__(self) -> Span | None:
+        return self.__enter__()
+
+    async def __aexit__(self, kind, error, traceback) -> None:
+        self.__exit__(kind, error, traceback)
+
+
+class MemoryExporter:
+    def __init__(self, keep: int = 10000) -> None:
+        self.spans = deque(maxlen=keep) # Zipkin dicts, oldest on the left
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span.zipkin())
+
+    def close(self) -> None:
+        pass
+
+
+class FileExporter:
+    """ Zipkin v2 JSON lines. Every worker appends to the same file, so each span is one unbuffered O_APPEND write
+    and lines from different processes (or executor threads) never end up cut into each other. """
+    def __init__(self, path: str) -> None:
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def export(self, span: Span) -> None:
+        os.write(self.fd, (dumps(span.zipkin()) + "\n").encode())
+
+    def close(self) -> None:
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.sample_rate = 0.0
+        self.exporter = None
+
+    def configure(self, sample_rate: float = 1.0, exporter: str = "file", path: str = "traces.jsonl", keep: int = 10000) -> None:
+        self.exporter = FileExporter(path) if exporter == "file" else MemoryExporter(keep)
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name: str, kind: str | None = None, **tags) -> Span | None:
+        """ Root span for a request, if it is sampled. Becomes the current span, finish it yourself. """
+        if self.exporter is None or random() >= self.sample_rate:
+            current.set(None)
+            return None
+        root = Span(f"{getrandbits(128):032x}", None, name, kind, tags)
+        current.set(root)
+        return root
+
+    def continue_trace(self, trace_id: str, parent_id: str, name: str, kind: str | None = None, **tags) -> Span:
+        """ A span somewhere else in an existing trace, like an event being fanned out. Not made current. """
+        return Span(trace_id, parent_id, name, kind, tags)
+
+    def export(self, span: Span) -> None:
+        if self.exporter is not None:
+            try:
+                self.exporter.export(span)
+            except Exception as e: # Full disk and the like, tracing never breaks a request.
+                print(f"Error exporting span\n{e}")
+
+    def close(self) -> None:
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+
+
+TRACER = Tracer()
@@ -0,0 +1,83 @@
+from asyncio import get_running_loop, create_task
+
+from utils.db import AsyncDB
+
+# Write-behind for hot inserts (messages). Rows are buffered per statement and written with one executemany,
+# in one transaction, once max_batch rows are waiting or max_delay seconds have passed since the first one.
+# ack decides when insert() returns:
+#   "flush":     after the batch holding the row is committed, failures raise in the caller like a normal execute.
+#   "immediate": as soon as the row is buffered, failures only reach on_error. Faster, but a crash loses what is buffered.
+# Batches are written on their own connection and transaction, never the request's, so this cant be combined with
+# db_request_transaction. Disabled, insert() runs on the db it is given, the request's lease and its transaction.
+
+acks = ("flush", "immediate")
+
+
+def log_failed_flush(stmt: str, rows: list[tuple], error: Exception) -> None:
+    print(f"Write-behind flush of {len(rows)} rows failed\nstatement: {stmt}\n{error}")
+
+
+class WriteBehind:
+    def __init__(self, db: AsyncDB, enabled: bool = False, max_batch: int = 100, max_delay: float = 0.01, ack: str = "flush",
+                 on_flush=None, on_error=log_failed_flush) -> None:
+        if ack not in acks:
+            raise ValueError(f"Write-behind ack has to be one of {', '.join(acks)}.")
+        self.db = db
+        self.enabled = enabled # Disabled, insert() is a plain execute on the caller's db.
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.ack = ack
+        self.on_flush = on_flush # (statement, rows) after a batch commits
+        self.on_error = on_error # (statement, rows, exception) after a batch fails
+        self.buffers = dict() # statement -> [(args, future or None)]
+        self.timers = dict() # statement -> TimerHandle for its delayed flush
+        self.flushing = set() # Running flush tasks, so they dont get garbage collected.
+
+    async def insert(self, db, stmt: str, *args) -> None:
+        """ db is what the caller would have run the insert on, request.ctx.db. Only used while disabled. """
+        if not self.enabled:
+            return await db.execute(stmt, *args)
+        loop = get_running_loop()
+        future = loop.create_future() if self.ack == "flush" else None
+        buffer = self.buffers.setdefault(stmt, [])
+        buffer.append((args, future))
+        if len(buffer) >= self.max_batch:
+            self.flush_soon(stmt)
+        elif stmt not in self.timers:
+            self.timers[stmt] = loop.call_later(self.max_delay, self.flush_soon, stmt)
+        if future is not None:
+            await future
+
+    def flush_soon(self, stmt: str) -> None:
+        task = create_task(self.flush(stmt))
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self, stmt: str) -> None:
+        timer = self.timers.pop(stmt, None)
+        if timer is not None:
+            timer.cancel()
+        buffered = self.buffers.pop(stmt, None)
+        if not buffered:
+            return
+        rows = [args for args, _ in buffered]
+        try:
+            await self.db.executemany(stmt, rows)
+        except Exception as e:
+            for _, future in buffered:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            if self.on_error is not None:
+                self.on_error(stmt, rows, e)
+            return
+        for _, future in buffered:
+            if future is not None and not future.done():
+                future.set_result(None)
+        if self.on_flush is not None:
+            self.on_flush(stmt, rows)
+
+    async def close(self) -> None: # Flush everything that is still buffered, call this before the DB goes away.
+        for stmt in list(self.buffers):
+            await self.flush(stmt)
+        for task in list(self.flushing):
+            await task